@@ -0,0 +1,366 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import metagrammar
+from cfg import CFG, Symbol
+from metagrammar import MetaGrammar
+from sequitur import Sequitur, Node
+from sharded import induce_corpus
+
+
+SIMPLE_GRAMMAR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'resources', 'simplegrammar.cfg')
+
+
+def time_it(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def append_symbols(n):
+    s = Sequitur()
+    sym_id = s.symbols.intern('a')
+    for _ in range(n):
+        s.append_to_start_rule(Node(sym_id, is_terminal=True))
+    return s
+
+
+def random_corpus(n, alphabet='abcdefghij', seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(alphabet) for _ in range(n)]
+
+
+def repetitive_corpus(n):
+    return list(('ab' * (n // 2 + 1))[:n])
+
+
+def phrase_corpus(n, num_phrases=50, seed=0):
+    """
+    Words drawn from a small set of fixed phrases, which is closer to natural text than uniformly random symbols
+    """
+    rng = random.Random(seed)
+    words = ['w%d' % i for i in range(200)]
+    phrases = [[rng.choice(words) for _ in range(rng.randint(2, 6))] for _ in range(num_phrases)]
+    seq = []
+    while len(seq) < n:
+        seq.extend(rng.choice(phrases))
+    return seq[:n]
+
+
+def grammar_corpus(n, seed=0):
+    """
+    Sentences sampled from resources/simplegrammar.cfg, concatenated
+    """
+    grammar = CFG()
+    grammar.load(SIMPLE_GRAMMAR_FILE)
+    grammar.rules[CFG.START_SYMBOL] = grammar.rules['S']
+    rng = random.Random(seed)
+    seq = []
+    while len(seq) < n:
+        seq.extend(grammar.generate(rng)['flat'].split())
+    return seq[:n]
+
+
+SUITE_CORPORA = [('random', random_corpus), ('simplegrammar', grammar_corpus), ('repetitive', repetitive_corpus)]
+
+
+def cfg_size(grammar: CFG):
+    return len(grammar.rules), sum(len(rhs) for alts in grammar.rules.values() for rhs in alts)
+
+
+def induce_sequitur(corpus):
+    s = Sequitur()
+    s.consume_sequence(corpus)
+    return s.grammar_size()
+
+
+def induce_metagrammar(corpus, sentence_len=10):
+    """
+    MetaGrammar takes text, so the corpus is cut into sentences of sentence_len words. run() prints as it goes, so
+    stdout is captured
+    """
+    text = '. '.join(' '.join(corpus[i:i + sentence_len]) for i in range(0, len(corpus), sentence_len))
+    mg = MetaGrammar(['x*'])
+    mg.initialize(text)
+    verbose = metagrammar.VERBOSE
+    with contextlib.redirect_stdout(io.StringIO()):
+        metagrammar.VERBOSE = False
+        try:
+            mg.run()
+        finally:
+            metagrammar.VERBOSE = verbose
+    return cfg_size(mg.grammar)
+
+
+SUITE_ALGORITHMS = [('sequitur', induce_sequitur), ('metagrammar', induce_metagrammar)]
+
+
+def load_results(filename):
+    with open(filename, 'r') as fh:
+        return [json.loads(line) for line in fh if len(line.strip()) > 0]
+
+
+def match_record_positions(mg):
+    return [(k, [(gp.lhs, gp.rhs_begin, gp.rhs_end) for gp in mr.grammar_positions])
+            for k, mr in mg.match_records.items()]
+
+
+def bench_start_rule_append(sizes):
+    """
+    Times appending n symbols to the start rule. with the rule tail pointer this should scale linearly, i.e. the
+    per-symbol cost should stay flat as n grows
+    """
+    print("%10s %12s %14s" % ("n", "seconds", "usec/symbol"))
+    for n in sizes:
+        secs = time_it(append_symbols, n)
+        print("%10d %12.4f %14.3f" % (n, secs, 1e6 * secs / n))
+
+
+def bench_consume(sizes):
+    """
+    Times grammar induction over corpora of increasing size. symbols/sec should stay roughly flat
+    """
+    print("%12s %10s %12s %14s" % ("corpus", "n", "seconds", "symbols/sec"))
+    for n in sizes:
+        for name, corpus in [('random', random_corpus(n)), ('phrases', phrase_corpus(n))]:
+            secs = time_it(Sequitur.run, corpus)
+            print("%12s %10d %12.4f %14.0f" % (name, n, secs, n / secs))
+
+
+def bench_rule_utility(n):
+    """
+    Reports grammar size (rules, rhs symbols) with single-use rules kept and with rule utility enforced
+    """
+    print("%12s %20s %20s" % ("corpus", "rules/symbols kept", "rules/symbols inlined"))
+    for name, corpus in [('random', random_corpus(n)), ('repetitive', repetitive_corpus(n)),
+                         ('phrases', phrase_corpus(n))]:
+        sizes = []
+        for rule_utility in [False, True]:
+            s = Sequitur(rule_utility=rule_utility)
+            s.consume_sequence(corpus)
+            sizes.append("%d/%d" % s.grammar_size())
+        print("%12s %20s %20s" % (name, sizes[0], sizes[1]))
+
+
+def bench_memory(n):
+    """
+    Reports memory held by the induced grammar (nodes, digram index and rule counts) per input symbol
+    """
+    print("%12s %16s" % ("corpus", "bytes/symbol"))
+    for name, corpus in [('random', random_corpus(n)), ('repetitive', repetitive_corpus(n)),
+                         ('phrases', phrase_corpus(n))]:
+        tracemalloc.start()
+        s = Sequitur()
+        s.consume_sequence(corpus)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%12s %16.1f" % (name, current / n))
+
+
+def bench_sharded(num_docs, doc_len, process_counts):
+    """
+    Times induce_corpus over independent documents for several process pool sizes
+    """
+    docs = [phrase_corpus(doc_len, seed=i) for i in range(num_docs)]
+    print("%10s %12s %14s %8s" % ("processes", "seconds", "symbols/sec", "rules"))
+    for processes in process_counts:
+        start = time.perf_counter()
+        grammar = induce_corpus(docs, processes=processes)
+        secs = time.perf_counter() - start
+        print("%10d %12.4f %14.0f %8d" % (processes, secs, num_docs * doc_len / secs, len(grammar.rules)))
+
+
+def bench_generate(grammar_file, start, n):
+    """
+    Sentences/sec for CFG.generate_many, CompiledCFG, ExpansionCache and (if numpy is available) BulkSampler
+    """
+    grammar = CFG()
+    grammar.load(grammar_file)
+    grammar.rules[CFG.START_SYMBOL] = grammar.rules[start]
+    compiled = grammar.compile()
+    runs = [('generate_many', lambda: grammar.generate_many(n, rng=0)),
+            ('compiled', lambda: compiled.generate_many(n, rng=0))]
+    cache = compiled.expansion_cache()
+    rng = random.Random(0)
+    runs.append(('expansion cache', lambda: [cache.sample(rng) for _ in range(n)]))
+    try:
+        # numpy is only needed for the bulk sampler
+        from bulk import BulkSampler
+        sampler = BulkSampler(compiled, seed=0)
+        runs.append(('bulk', lambda: sampler.sample(n)))
+    except ImportError:
+        print("numpy not available, skipping bulk sampler")
+    print("%16s %12s %16s" % ("sampler", "seconds", "sentences/sec"))
+    for name, fn in runs:
+        secs = time_it(fn)
+        print("%16s %12.4f %16.0f" % (name, secs, n / secs))
+
+
+def random_grammar(num_rules, num_words=5000, seed=0):
+    """
+    A grammar of num_rules nonterminals, each with one alternative of two symbols that are either words or later
+    nonterminals, under a start rule that picks from 2000 of them
+    """
+    rng = random.Random(seed)
+    words = [Symbol('w%d' % i, True) for i in range(num_words)]
+    rules = {CFG.START_SYMBOL: [[Symbol('N%d' % rng.randrange(num_rules), False) for _ in range(5)]
+                                for _ in range(2000)]}
+    for i in range(num_rules):
+        alt = []
+        for _ in range(2):
+            if i + 1 < num_rules and rng.random() < 0.5:
+                alt.append(Symbol('N%d' % rng.randrange(i + 1, num_rules), False))
+            else:
+                alt.append(rng.choice(words))
+        rules['N%d' % i] = [alt]
+    return CFG.from_dict(rules)
+
+
+def bench_load(num_rules):
+    """
+    Seconds to load and compile a grammar of num_rules rules from its text and binary forms
+    """
+    grammar = random_grammar(num_rules)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        text_file = os.path.join(tmp_dir, 'grammar.cfg')
+        binary_file = os.path.join(tmp_dir, 'grammar.bin')
+        with open(text_file, 'w') as fh:
+            fh.write(str(grammar))
+        grammar.save_binary(binary_file)
+        del grammar
+        print("%8s %12s %12s" % ("format", "load secs", "compile secs"))
+        for name, load in [('text', lambda: load_text(text_file)), ('binary', lambda: CFG.load_binary(binary_file))]:
+            start = time.perf_counter()
+            loaded = load()
+            load_secs = time.perf_counter() - start
+            print("%8s %12.3f %12.3f" % (name, load_secs, time_it(loaded.compile)))
+            del loaded
+
+
+def load_text(filename):
+    grammar = CFG()
+    grammar.load(filename)
+    return grammar
+
+
+def bench_suite(n, out_fh=None, repeats=3):
+    """
+    Runs every algorithm over every fixed corpus of n symbols. speed is the best of repeats untraced runs, peak
+    memory comes from one more run under tracemalloc. compression is input symbols per rhs symbol of the grammar
+    :param out_fh: if given, one json object per result is written to it (see compare_results)
+    :return: list of results
+    """
+    results = []
+    print("%12s %14s %14s %12s %8s %10s %12s" %
+          ("algorithm", "corpus", "symbols/sec", "peak KiB", "rules", "symbols", "compression"))
+    for corpus_name, make_corpus in SUITE_CORPORA:
+        corpus = make_corpus(n)
+        for algorithm, induce in SUITE_ALGORITHMS:
+            secs = min(time_it(induce, corpus) for _ in range(repeats))
+            tracemalloc.start()
+            (rules, symbols) = induce(corpus)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result = {'algorithm': algorithm, 'corpus': corpus_name, 'n': n, 'seconds': secs,
+                      'symbols_per_sec': n / secs, 'peak_bytes': peak, 'rules': rules, 'rhs_symbols': symbols,
+                      'compression': n / max(symbols, 1), 'python': platform.python_version()}
+            results.append(result)
+            if out_fh is not None:
+                out_fh.write(json.dumps(result, sort_keys=True) + '\n')
+            print("%12s %14s %14.0f %12.1f %8d %10d %12.2f" %
+                  (algorithm, corpus_name, result['symbols_per_sec'], peak / 1024, rules, symbols,
+                   result['compression']))
+    return results
+
+
+def compare_results(before, after):
+    """
+    Prints the ratio after/before of speed, peak memory and grammar size for every (algorithm, corpus, n) found
+    in both result lists
+    """
+    baseline = dict(((r['algorithm'], r['corpus'], r['n']), r) for r in before)
+    print("%12s %14s %10s %12s %12s %12s" % ("algorithm", "corpus", "n", "speed", "peak mem", "grammar"))
+    for r in after:
+        b = baseline.get((r['algorithm'], r['corpus'], r['n']))
+        if b is None:
+            continue
+        print("%12s %14s %10d %11.2fx %11.2fx %11.2fx" %
+              (r['algorithm'], r['corpus'], r['n'], r['symbols_per_sec'] / b['symbols_per_sec'],
+               r['peak_bytes'] / b['peak_bytes'], r['rhs_symbols'] / max(b['rhs_symbols'], 1)))
+
+
+def bench_pattern_matching(num_sentences=400, pattern_strings=('xy', 'xyx', 'x*', 'xy*y')):
+    """
+    Finds pattern matches over Sense and Sensibility (from nltk's gutenberg corpus, or sentences sampled from
+    simplegrammar.cfg if that isn't installed) with the PatternTemplate engine and with the compiled PatternMatcher,
+    checks that both give the same match records and reports symbols/sec for each
+    """
+    try:
+        text = metagrammar.sense_and_sensibility(how_many=num_sentences)
+        source = 'sense and sensibility'
+    except LookupError:
+        corpus = grammar_corpus(num_sentences * 20)
+        text = '. '.join(' '.join(corpus[i:i + 20]) for i in range(0, len(corpus), 20))
+        source = 'simplegrammar.cfg (nltk gutenberg corpus not installed)'
+    results = []
+    verbose = metagrammar.VERBOSE
+    metagrammar.VERBOSE = False
+    for engine in ['templates', 'compiled']:
+        mg = MetaGrammar(list(pattern_strings))
+        mg.initialize(text)
+        rhss = [(lhs, rhs) for lhs in mg.grammar.rules.keys() for rhs in mg.grammar.rules[lhs]]
+        num_symbols = sum(len(rhs) for _, rhs in rhss)
+        start = time.perf_counter()
+        for lhs, rhs in rhss:
+            if engine == 'templates':
+                mg.consume_sequence(rhs, lhs)
+                mg.reset_all_pattern_templates()
+            else:
+                mg.match_sequence(rhs, lhs)
+        secs = time.perf_counter() - start
+        results.append((engine, secs, match_record_positions(mg)))
+    metagrammar.VERBOSE = verbose
+    print("%s, %d symbols, patterns %s" % (source, num_symbols, ' '.join(pattern_strings)))
+    print("%12s %12s %14s %10s" % ("engine", "seconds", "symbols/sec", "records"))
+    for engine, secs, records in results:
+        print("%12s %12.4f %14.0f %10d" % (engine, secs, num_symbols / secs, len(records)))
+    if results[0][2] != results[1][2]:
+        raise Exception("compiled matcher found different match records")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        # benchmark.py suite [n] [results.jsonl]
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        if len(sys.argv) > 3:
+            with open(sys.argv[3], 'w') as results_fh:
+                bench_suite(n, results_fh)
+        else:
+            bench_suite(n)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'patterns':
+        bench_pattern_matching(int(sys.argv[2]) if len(sys.argv) > 2 else 400)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'load':
+        # benchmark.py load [num_rules]
+        bench_load(int(sys.argv[2]) if len(sys.argv) > 2 else 500000)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        # benchmark.py compare before.jsonl after.jsonl
+        compare_results(load_results(sys.argv[2]), load_results(sys.argv[3]))
+        sys.exit(0)
+    max_exp = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    sizes = [10 ** e for e in range(3, max_exp + 1)]
+    bench_start_rule_append(sizes)
+    bench_consume(sizes)
+    bench_rule_utility(sizes[-1])
+    bench_memory(sizes[-1])
+    bench_sharded(100, sizes[-1] // 100, sorted(set([1, 2, os.cpu_count() or 1])))
+    bench_generate(SIMPLE_GRAMMAR_FILE, 'S', sizes[-1] // 100)
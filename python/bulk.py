@@ -0,0 +1,125 @@
+import sys
+import numpy as np
+from cfg import CFG, CompiledCFG
+
+
+class BulkSampler:
+    """
+    Samples sentences from a CompiledCFG a whole population at a time. all sentences of a batch live in one flat
+    array of symbols (nonterminal indexes, or ~t for terminal t, as in CompiledCFG.rhs) and every step rewrites all
+    nonterminals on the frontier at once, with a single array of random draws. the result is ragged: a flat array
+    of terminal ids plus offsets, sentence i being tokens[offsets[i]:offsets[i+1]]
+    """
+
+    def __init__(self, compiled: CompiledCFG, seed=None):
+        self.compiled = compiled
+        self.rng = np.random.default_rng(seed)
+        self.rhs = np.asarray(compiled.rhs, dtype=np.int32)
+        self.alt_rhs = np.asarray(compiled.alt_rhs, dtype=np.int64)
+        self.alt_len = np.diff(self.alt_rhs)
+        nt_alts = np.asarray(compiled.nt_alts, dtype=np.int64)
+        self.first_alt = nt_alts[:-1]
+        self.num_alts = np.diff(nt_alts)
+        self.alt_keys = None
+        if compiled.cum_weights is not None:
+            # nonterminal index plus the normalized running weight, so one searchsorted over all alternatives
+            # picks within the right nonterminal
+            cum = np.asarray(compiled.cum_weights, dtype=np.float64)
+            alt_nt = np.repeat(np.arange(len(self.num_alts)), self.num_alts)
+            totals = cum[nt_alts[1:] - 1]
+            self.alt_keys = alt_nt + cum / totals[alt_nt]
+
+    def choose(self, nts):
+        u = self.rng.random(len(nts))
+        last = self.first_alt[nts] + self.num_alts[nts] - 1
+        if self.alt_keys is None:
+            alts = self.first_alt[nts] + (u * self.num_alts[nts]).astype(np.int64)
+        else:
+            alts = np.searchsorted(self.alt_keys, nts + u, side='right')
+        return np.minimum(alts, last)
+
+    def sample(self, n, max_steps=1000):
+        """
+        Expands the derivation trees of n sentences one level at a time, then lays the terminals out in a single
+        pass: yield lengths are summed bottom up and start positions handed down top down. every node of the trees
+        is touched a constant number of times, instead of the sentences being recopied at every level
+        :param n: number of sentences
+        :param max_steps: give up if some derivation is still not finished after this many levels
+        :return: (tokens, offsets) as described in the class docstring
+        """
+        frontier = np.zeros(n, dtype=np.int32)
+        # per level: the children of that level's nonterminals, which of them each child belongs to, and for
+        # nonterminal children their index in the next level
+        levels = []
+        for _ in range(max_steps):
+            if len(frontier) == 0:
+                break
+            alts = self.choose(frontier)
+            num_children = self.alt_len[alts]
+            first_child = np.cumsum(num_children) - num_children
+            parent = np.repeat(np.arange(len(frontier)), num_children)
+            within = np.arange(len(parent)) - first_child[parent]
+            children = self.rhs[self.alt_rhs[alts][parent] + within]
+            is_nt = children >= 0
+            next_idx = np.cumsum(is_nt) - 1
+            levels.append((children, parent, first_child, is_nt, next_idx))
+            frontier = children[is_nt]
+        else:
+            if len(frontier) > 0:
+                raise Exception("derivations did not terminate after %d steps" % max_steps)
+        # yield length of every node, deepest level first
+        child_lengths = [None] * len(levels)
+        node_lengths = np.zeros(0, dtype=np.int64)
+        for depth in range(len(levels) - 1, -1, -1):
+            (children, parent, first_child, is_nt, next_idx) = levels[depth]
+            lengths = np.ones(len(children), dtype=np.int64)
+            lengths[is_nt] = node_lengths[next_idx[is_nt]]
+            child_lengths[depth] = lengths
+            node_lengths = np.bincount(parent, weights=lengths, minlength=len(first_child)).astype(np.int64)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(node_lengths, out=offsets[1:])
+        tokens = np.empty(offsets[-1], dtype=np.int32)
+        # start position of every node, top level first
+        node_starts = offsets[:-1]
+        for depth in range(len(levels)):
+            (children, parent, first_child, is_nt, next_idx) = levels[depth]
+            lengths = child_lengths[depth]
+            before = np.cumsum(lengths) - lengths
+            starts = node_starts[parent] + before - before[first_child[parent]]
+            tokens[starts[~is_nt]] = ~children[~is_nt]
+            node_starts = starts[is_nt]
+        return tokens, offsets
+
+    def sample_batches(self, n, batch_size=100000, max_steps=1000):
+        """
+        Generates n sentences in batches, so the population never has to hold all of them at once
+        """
+        done = 0
+        while done < n:
+            size = min(batch_size, n - done)
+            yield self.sample(size, max_steps)
+            done += size
+
+    @staticmethod
+    def to_matrix(tokens, offsets, pad=-1):
+        """
+        :return: one row per sentence, padded on the right with pad
+        """
+        lengths = np.diff(offsets)
+        mat = np.full((len(lengths), lengths.max(initial=0)), pad, dtype=np.int64)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        cols = np.arange(len(tokens)) - offsets[rows]
+        mat[rows, cols] = tokens
+        return mat
+
+    def decode(self, tokens, offsets) -> list:
+        terminals = self.compiled.terminals
+        return [' '.join([terminals[t] for t in tokens[offsets[i]:offsets[i + 1]]]) for i in range(len(offsets) - 1)]
+
+
+if __name__ == '__main__':
+    cfg = CFG()
+    cfg.load(sys.argv[1])
+    sampler = BulkSampler(cfg.compile(start=sys.argv[2] if len(sys.argv) > 2 else None))
+    (tokens, offsets) = sampler.sample(10)
+    print('\n'.join(sampler.decode(tokens, offsets)))
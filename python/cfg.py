@@ -1,58 +1,325 @@
 import string
 import random
 import re
+import sys
+import mmap
+import struct
+from array import array
 from collections import defaultdict
 import collections
+import collections.abc
+import math
+import warnings
+import weakref
 
 
 class Symbol:
+    """
+    Symbols are interned: constructing a symbol with the value and terminal flag of an existing one returns that
+    same object. equality and hashing are therefore by identity, symbols can be used in sets and as dict keys, and
+    a terminal and a nonterminal with the same value are different symbols. symbols are immutable.
+    the intern table only holds weak references, so a symbol no grammar uses any more is freed as usual
+    """
 
-    uid = 0
+    __slots__ = ('val', 'is_terminal', 'uid', '__weakref__')
 
-    def __init__(self, val, is_terminal):
-        self.val = self.clean(val)
-        self.is_terminal = is_terminal
-        self.uid = Symbol.get_uid()
+    next_uid = 0
+    # (cleaned value, is_terminal) -> weak reference to the symbol. entries of freed symbols are dropped by purge,
+    # which runs whenever the table has doubled since the last one, so it never holds many more entries than there
+    # are live symbols. plain refs without callbacks are several times cheaper to make than a WeakValueDictionary's
+    table = dict()
+    purge_at = 1024
+
+    def __new__(cls, val, is_terminal):
+        is_terminal = bool(is_terminal)
+        if "'" in val:
+            val = Symbol.clean(val)
+        key = (val, is_terminal)
+        ref = Symbol.table.get(key)
+        if ref is not None:
+            sym = ref()
+            if sym is not None:
+                return sym
+        sym = object.__new__(cls)
+        Symbol.set_val(sym, val)
+        Symbol.set_is_terminal(sym, is_terminal)
+        Symbol.set_uid(sym, Symbol.get_uid())
+        Symbol.table[key] = weakref.ref(sym)
+        if len(Symbol.table) >= Symbol.purge_at:
+            Symbol.purge()
+        return sym
+
+    @staticmethod
+    def purge():
+        Symbol.table = dict((key, ref) for key, ref in Symbol.table.items() if ref() is not None)
+        Symbol.purge_at = max(1024, 2 * len(Symbol.table))
+
+    def __setattr__(self, name, value):
+        raise Exception("symbols are interned and can't be modified")
+
+    def __reduce__(self):
+        # unpickled symbols (e.g. coming back from a process pool) are interned again
+        return Symbol, (self.val, self.is_terminal)
 
     def __str__(self):
         return "%s" % self.val if self.is_terminal else "<%s>" % self.val
 
-    def __eq__(self, other):
-        return self.val == other.val
+    def __repr__(self):
+        return "Symbol(%r, %r)" % (self.val, self.is_terminal)
 
     @staticmethod
     def get_uid():
-        Symbol.uid += 1
-        return Symbol.uid
+        Symbol.next_uid += 1
+        return Symbol.next_uid
 
-    def clean(self, sym):
+    @staticmethod
+    def clean(sym):
         return sym.replace("'", "")
 
 
+# the slots' own setters, which skip the __setattr__ that keeps symbols immutable
+Symbol.set_val = Symbol.val.__set__
+Symbol.set_is_terminal = Symbol.is_terminal.__set__
+Symbol.set_uid = Symbol.uid.__set__
+
+
+class AliasTable:
+    """
+    Walker's alias method (Vose's construction): after O(k) setup, one of k outcomes is drawn with probability
+    proportional to its weight in constant time, with a single uniform draw. slot i keeps outcome i with probability
+    prob[i] and otherwise gives alias[i]
+    """
+
+    def __init__(self, weights):
+        (self.prob, self.alias) = AliasTable.build(weights)
+
+    def __len__(self):
+        return len(self.prob)
+
+    @staticmethod
+    def build(weights):
+        k = len(weights)
+        total = float(sum(weights))
+        if k == 0 or total <= 0 or any(w < 0 for w in weights):
+            raise Exception("bad weights %s" % str(weights))
+        scaled = [w * k / total for w in weights]
+        prob = [1.0] * k
+        alias = list(range(k))
+        small = [i for i in range(k) if scaled[i] < 1.0]
+        large = [i for i in range(k) if scaled[i] >= 1.0]
+        while len(small) > 0 and len(large) > 0:
+            s = small.pop()
+            g = large[-1]
+            prob[s] = scaled[s]
+            alias[s] = g
+            scaled[g] -= 1.0 - scaled[s]
+            if scaled[g] < 1.0:
+                small.append(large.pop())
+        # whatever is left is 1 up to rounding
+        return prob, alias
+
+    def sample(self, rng=random) -> int:
+        x = rng.random() * len(self.prob)
+        i = min(int(x), len(self.prob) - 1)
+        return i if x - i < self.prob[i] else self.alias[i]
+
+
+class MappedRules(collections.abc.MutableMapping):
+    """
+    Rules of a grammar stored in the binary format written by CFG.save_binary. the file is memory mapped and a rule's
+    alternatives are only turned into Symbol lists the first time the rule is looked up. assigned rules are kept in
+    memory and take precedence over the mapped ones, so a loaded grammar can still be modified
+
+    layout (all integers are little endian uint32):
+        header: magic, version, number of symbols, number of rules, number of alternatives, number of rhs symbols,
+                size of the string blob
+        lhs:         symbol id of each rule's lhs
+        rule_alts:   rule i's alternatives are rule_alts[i]..rule_alts[i+1]
+        alt_syms:    alternative j's rhs is rhs[alt_syms[j]..alt_syms[j+1]]
+        rhs:         symbol ids
+        sym_offsets: symbol k's value is blob[sym_offsets[k]..sym_offsets[k+1]] (utf-8)
+        terminal:    1 byte per symbol, 1 if the symbol is a terminal
+        blob:        symbol values
+    """
+
+    MAGIC = 0x47464355  # 'UCFG'
+    VERSION = 1
+    HEADER = struct.Struct('<7I')
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, num_syms, num_rules, num_alts, num_rhs, blob_size) = MappedRules.HEADER.unpack_from(self.mm, 0)
+        if magic != MappedRules.MAGIC or version != MappedRules.VERSION:
+            raise Exception("%s is not a binary grammar file" % filename)
+        offset = MappedRules.HEADER.size
+        (self.lhs, offset) = self.read_ints(offset, num_rules)
+        (self.rule_alts, offset) = self.read_ints(offset, num_rules + 1)
+        (self.alt_syms, offset) = self.read_ints(offset, num_alts + 1)
+        (self.rhs, offset) = self.read_ints(offset, num_rhs)
+        (self.sym_offsets, offset) = self.read_ints(offset, num_syms + 1)
+        self.terminal = self.mm[offset:offset + num_syms]
+        self.blob_offset = offset + num_syms
+        # symbols are only made when a rule using them is decoded, only the names of the rules are read up front
+        self.symbols = [None] * num_syms
+        self.rule_index = dict((self.value(self.lhs[i]), i) for i in range(num_rules))
+        self.loaded = dict()
+        self.removed = set()
+        # whether any rule was assigned or deleted since loading
+        self.modified = False
+
+    def read_ints(self, offset, count):
+        end = offset + 4 * count
+        if sys.byteorder == 'little':
+            return memoryview(self.mm)[offset:end].cast('I'), end
+        ints = array('I', self.mm[offset:end])
+        ints.byteswap()
+        return ints, end
+
+    def value(self, k) -> str:
+        # the offsets are byte offsets, so the value is cut out of the raw blob before decoding
+        base = self.blob_offset
+        return self.mm[base + self.sym_offsets[k]:base + self.sym_offsets[k + 1]].decode('utf-8')
+
+    def symbol(self, k) -> Symbol:
+        sym = self.symbols[k]
+        if sym is None:
+            sym = Symbol(self.value(k), self.terminal[k] == 1)
+            self.symbols[k] = sym
+        return sym
+
+    def decode_rule(self, rule_idx):
+        alts = []
+        for j in range(self.rule_alts[rule_idx], self.rule_alts[rule_idx + 1]):
+            alts.append([self.symbol(k) for k in self.rhs[self.alt_syms[j]:self.alt_syms[j + 1]]])
+        return alts
+
+    def encode_reachable(self, start):
+        """
+        Same as CompiledCFG.encode_reachable, read straight from the integer tables
+        """
+        rule_alts, alt_syms, rhs, terminal = self.rule_alts, self.alt_syms, self.rhs, self.terminal
+        # symbol id of each lhs -> its rule
+        rule_of = dict((sym_id, i) for i, sym_id in enumerate(self.lhs))
+        nonterminals = [start]
+        terminals = []
+        t_ids = dict()
+        start_rule = self.rule_index.get(start)
+        nt_ids = dict() if start_rule is None else {self.lhs[start_rule]: 0}
+        # rule of each nonterminal, None if it has none
+        nt_rules = [start_rule]
+        alternatives = []
+        undefined = []
+        i = 0
+        while i < len(nonterminals):
+            rule_idx = nt_rules[i]
+            encoded = []
+            if rule_idx is not None:
+                for j in range(rule_alts[rule_idx], rule_alts[rule_idx + 1]):
+                    enc = []
+                    for k in rhs[alt_syms[j]:alt_syms[j + 1]]:
+                        if terminal[k] == 1:
+                            t = t_ids.get(k)
+                            if t is None:
+                                t = t_ids[k] = len(terminals)
+                                terminals.append(self.value(k))
+                            enc.append(~t)
+                        else:
+                            n = nt_ids.get(k)
+                            if n is None:
+                                n = nt_ids[k] = len(nonterminals)
+                                nonterminals.append(self.value(k))
+                                nt_rules.append(rule_of.get(k))
+                            enc.append(n)
+                    encoded.append(enc)
+            if len(encoded) == 0:
+                undefined.append(nonterminals[i])
+            alternatives.append(encoded)
+            i += 1
+        return nonterminals, terminals, alternatives, undefined
+
+    def __getitem__(self, lhs):
+        if lhs in self.loaded:
+            return self.loaded[lhs]
+        if lhs in self.rule_index and lhs not in self.removed:
+            alts = self.decode_rule(self.rule_index[lhs])
+            self.loaded[lhs] = alts
+            return alts
+        # same as the defaultdict used by CFG, but without inserting the missing key
+        return ''
+
+    def __setitem__(self, lhs, alts):
+        self.loaded[lhs] = alts
+        self.removed.discard(lhs)
+        self.modified = True
+
+    def __delitem__(self, lhs):
+        if lhs not in self:
+            raise KeyError(lhs)
+        self.loaded.pop(lhs, None)
+        if lhs in self.rule_index:
+            self.removed.add(lhs)
+        self.modified = True
+
+    def __contains__(self, lhs):
+        return lhs in self.loaded or (lhs in self.rule_index and lhs not in self.removed)
+
+    def __iter__(self):
+        for lhs in self.rule_index:
+            if lhs not in self.removed:
+                yield lhs
+        for lhs in self.loaded:
+            if lhs not in self.rule_index:
+                yield lhs
+
+    def __len__(self):
+        return len(self.rule_index) - len(self.removed) + len([k for k in self.loaded if k not in self.rule_index])
+
+
 class CFG:
 
     OR_SEP = '|'
     SYMBOL_SEP = ' '
     START_SYMBOL = '_S_'
     LHS_RHS_SEP = '->'
+    # written for an empty alternative, which would otherwise leave nothing between the separators
+    EPSILON = 'ε'
+    # a # at the start of a line or after whitespace starts a comment
+    COMMENT_RE = re.compile(r'(^|\s)#')
     _uid = 0
 
     def __init__(self):
         self.rules = defaultdict(lambda: '')
         self.initial_lhs = CFG.START_SYMBOL
         self.terminals = []
+        # lhs -> one weight per alternative, in the order of rules[lhs]. rules without weights are uniform
+        self.weights = dict()
+        self.alias_tables = dict()
 
     def __str__(self):
         d = self.to_serializable()
-        s = "%s %s %s\n" % (self.START_SYMBOL, CFG.LHS_RHS_SEP, CFG.OR_SEP.join([CFG.SYMBOL_SEP.join([str(x) for x in s])
-                                                                          for s in self.rules[self.START_SYMBOL]]))
+        s = "%s %s %s\n" % (self.START_SYMBOL, CFG.LHS_RHS_SEP,
+                            CFG.OR_SEP.join([CFG.rhs_string(rhs) for rhs in self.rules[self.START_SYMBOL]]))
         keys_no_start = [ki for ki in filter(lambda k: k != self.START_SYMBOL, d.keys())]
         for k in sorted(keys_no_start):
             rhs_lst = self.rules[k]
-            rhs_str = CFG.OR_SEP.join(CFG.SYMBOL_SEP.join([str(r) for r in rhs]) for rhs in rhs_lst)
+            rhs_str = CFG.OR_SEP.join(CFG.rhs_string(rhs) for rhs in rhs_lst)
             s += "%s %s %s\n" % (k, CFG.LHS_RHS_SEP, rhs_str)
         return s
 
+    @staticmethod
+    def rhs_string(rhs) -> str:
+        if len(rhs) == 0:
+            return CFG.EPSILON
+        return CFG.SYMBOL_SEP.join([CFG.symbol_string(sym) for sym in rhs])
+
+    @staticmethod
+    def symbol_string(sym: Symbol) -> str:
+        # quote terminals that would otherwise be read back as nonterminals, comments or empty alternatives by load
+        if sym.is_terminal and (not CFG.is_terminal(sym.val) or sym.val == CFG.EPSILON or sym.val.startswith('#')):
+            return "'%s'" % sym.val
+        return str(sym)
+
     def add_from_tuple(self, rhs, lhs):
         self.rules[lhs.strip()] = []
 
@@ -76,7 +343,7 @@ class CFG:
     @staticmethod
     def flatten(list_of_lists):
         for el in list_of_lists:
-            if isinstance(el, collections.Iterable) and not isinstance(el, Symbol):
+            if isinstance(el, collections.abc.Iterable) and not isinstance(el, Symbol):
                 yield from CFG.flatten(el)
             else:
                 yield el
@@ -99,18 +366,162 @@ class CFG:
         d['parent'] = parent
         return d
 
-    def generate(self) -> list:
+    def choose_alternative(self, lhs: str, rng) -> list:
+        or_rules = self.rules[lhs]
+        if len(or_rules) == 0:
+            raise Exception("Can't find %s in the rules" % lhs)
+        if lhs not in self.weights:
+            return rng.choice(or_rules)
+        table = self.alias_tables.get(lhs)
+        if table is None:
+            table = AliasTable(self.weights[lhs])
+            self.alias_tables[lhs] = table
+        if len(table) != len(or_rules):
+            raise Exception("%d weights for the %d alternatives of %s" % (len(table), len(or_rules), lhs))
+        return or_rules[table.sample(rng)]
+
+    def set_weights(self, lhs: str, weights):
+        """
+        :param weights: one non-negative weight per alternative of lhs, in order. None goes back to uniform
+        """
+        self.alias_tables.pop(lhs, None)
+        if weights is None:
+            self.weights.pop(lhs, None)
+            return
+        if len(weights) != len(self.rules[lhs]) or any(w < 0 for w in weights) or sum(weights) <= 0:
+            raise Exception("bad weights for %s" % lhs)
+        self.weights[lhs] = list(weights)
+
+    def alternative_probabilities(self, lhs: str) -> list:
+        weights = self.weights.get(lhs)
+        if weights is None:
+            return [1.0 / len(self.rules[lhs])] * len(self.rules[lhs])
+        total = float(sum(weights))
+        return [w / total for w in weights]
+
+    def collapse_duplicates(self):
+        """
+        Merges identical alternatives of every rule into one, whose weight is the sum of theirs (so with no weights
+        set, the number of times the alternative occurred). MetaGrammar, for instance, adds one alternative per
+        match of a wildcard, so this turns its match counts into weights. rules without alternatives (including
+        the empty entries that looking up a missing rule leaves behind) are left alone
+        """
+        for (lhs, alts) in list(self.rules.items()):
+            if len(alts) == 0:
+                continue
+            weights = self.weights.get(lhs, [1] * len(alts))
+            merged = dict()
+            for alt, w in zip(alts, weights):
+                key = tuple(alt)
+                merged[key] = merged.get(key, 0) + w
+            self.rules[lhs] = [list(key) for key in merged.keys()]
+            self.alias_tables.pop(lhs, None)
+            self.weights[lhs] = list(merged.values())
+
+    def estimate_weights(self, sentences, start=None, smoothing=0.0):
+        """
+        Sets every rule's weights to how often each alternative is used when parsing a corpus (one parse per
+        sentence, see earley.EarleyParser) plus smoothing. sentences the grammar can't parse are skipped
+        :param sentences: list of sentences, each a list of terminal values
+        :return: number of sentences parsed
+        """
+        from earley import EarleyParser
+        parser = EarleyParser(self, start)
+        counts = dict((lhs, [smoothing] * len(self.rules[lhs])) for lhs in parser.compiled.nonterminals)
+        num_parsed = 0
+        for sentence in sentences:
+            forest = parser.parse(sentence)
+            if forest is None:
+                continue
+            num_parsed += 1
+            used = []
+            forest.tree(used=used)
+            for (lhs, alt) in used:
+                counts[lhs][alt] += 1
+        for lhs, lhs_counts in counts.items():
+            self.set_weights(lhs, lhs_counts if sum(lhs_counts) > 0 else None)
+        return num_parsed
+
+    def log_likelihood(self, sentences, start=None) -> float:
+        """
+        Natural log of the probability of a corpus under the weights, summed over all parses of every sentence.
+        -inf if some sentence is not in the language
+        """
+        from earley import EarleyParser
+        parser = EarleyParser(self, start)
+        probs = dict((lhs, self.alternative_probabilities(lhs)) for lhs in parser.compiled.nonterminals)
+        total = 0.0
+        for sentence in sentences:
+            forest = parser.parse(sentence)
+            p = 0.0 if forest is None else forest.inside(lambda lhs, alt: probs[lhs][alt])
+            if p <= 0.0:
+                return float('-inf')
+            total += math.log(p)
+        return total
+
+    def expand(self, rng, want_tree=False) -> dict:
+        """
+        Expands the start symbol depth first, left to right, using an explicit stack rather than recursion, so the
+        depth of a derivation is not limited by the interpreter's recursion limit
+        :param rng: random.Random (or the random module) used to pick alternatives
+        :param want_tree: also build the derivation tree in the form of to_serializeable_tree
+        :return: dict with the space separated terminals under 'flat' and, if wanted, the tree under 'tree'
+        """
+        flat = []
+        tree = {'name': CFG.get_uid(), 'children': [], 'parent': 'null'} if want_tree else None
+        stack = [(iter(self.choose_alternative(CFG.START_SYMBOL, rng)), tree)]
+        while len(stack) > 0:
+            (rhs_iter, node) = stack[-1]
+            sym = next(rhs_iter, None)
+            if sym is None:
+                stack.pop()
+            elif sym.is_terminal:
+                flat.append(sym.val)
+                if want_tree:
+                    node['children'].append({'name': sym.val, 'parent': node['name']})
+            else:
+                child = None
+                if want_tree:
+                    child = {'name': CFG.get_uid(), 'children': [], 'parent': node['name']}
+                    node['children'].append(child)
+                stack.append((iter(self.choose_alternative(sym.val, rng)), child))
+        gen = {'flat': ' '.join(flat)}
+        if want_tree:
+            gen['tree'] = tree
+        return gen
+
+    def generate(self, rng=None) -> dict:
+        if CFG.START_SYMBOL not in self.rules.keys():
+            raise Exception("problem with initial rule")
+        return self.expand(random if rng is None else rng, want_tree=True)
+
+    def generate_many(self, n, want_tree=False, rng=None) -> list:
+        """
+        Generates n random sentences
+        :param n: number of sentences
+        :param want_tree: build derivation trees as well. off by default because they cost more than the sentences
+        :param rng: random.Random to use, or an int seed for a new one, so runs can be reproduced
+        :return: list of dicts like the one returned by generate (without 'tree' unless asked for)
+        """
         if CFG.START_SYMBOL not in self.rules.keys():
             raise Exception("problem with initial rule")
-        lols = self.get_next(Symbol(CFG.START_SYMBOL, is_terminal=False))
-        flat_lols = list(CFG.flatten(lols))
-        tree_lols = CFG.to_serializeable_tree(lols)
-        return {'flat': ' '.join([f.val for f in flat_lols]), 'tree': tree_lols}
+        if rng is None:
+            rng = random
+        elif isinstance(rng, int):
+            rng = random.Random(rng)
+        return [self.expand(rng, want_tree) for _ in range(n)]
 
     @staticmethod
     def is_terminal(sym: Symbol) -> bool:
         return sym.strip()[0] in string.ascii_lowercase or "'" in list(sym)
 
+    @staticmethod
+    def parse_symbol(token: str) -> Symbol:
+        # <X> is how __str__ writes nonterminals, anything else goes by is_terminal
+        if len(token) > 2 and token[0] == '<' and token[-1] == '>':
+            return Symbol(val=token[1:-1], is_terminal=False)
+        return Symbol(val=token, is_terminal=CFG.is_terminal(token))
+
     @staticmethod
     def parse_rhs_clauses(rhs_str):
         rhs_str_spl = rhs_str.split(CFG.SYMBOL_SEP)
@@ -128,12 +539,141 @@ class CFG:
         cleaned_text = re.sub(r"  *", " ", cleaned_text)
         self.rules[CFG.START_SYMBOL] = self.parse_rhs_or_clauses(cleaned_text)
 
-    def load(self, filename):
-        f = open(filename, 'r')
-        for line in f.readlines():
-            (lhs, rhs_str) = [s.strip() for s in line.split('->')]
-            # there can be multiple rhs of a rule because of the 'or' symbol
-            self.rules[lhs.strip()] = self.parse_rhs_or_clauses(rhs_str)
+    def load(self, filename, validate=True):
+        with open(filename, 'r', encoding='utf-8') as fh:
+            self.load_lines(fh, filename, validate)
+
+    def load_lines(self, lines, source='<lines>', validate=True):
+        """
+        Reads rules one line at a time, in the format of the grammar files in resources and of __str__:
+
+            LHS -> a B | c <D>      # alternatives separated by |, <D> is always a nonterminal
+                 | e                # a line starting with | adds alternatives to the previous rule
+            E -> f \\                # a trailing backslash continues the line
+                 g | ε              # ε is the empty alternative
+
+        a # at the start of a line or after whitespace starts a comment that runs to the end of the line, blank
+        lines are skipped, and a lhs that appears again gets more alternatives
+        :param lines: iterable of lines, e.g. an open file
+        :param source: name used in error messages
+        :param validate: fail if a nonterminal is used but never defined
+        """
+        first_use = dict()
+        # token -> symbol, so a token seen before is not parsed again
+        parsed = dict()
+        lhs = None
+        logical_line = ''
+        start_lineno = 0
+        for lineno, line in enumerate(lines, 1):
+            if '#' in line:
+                comment = CFG.COMMENT_RE.search(line)
+                if comment is not None:
+                    line = line[:comment.start()]
+            line = line.strip()
+            if len(logical_line) == 0:
+                start_lineno = lineno
+            if line.endswith('\\'):
+                logical_line += line[:-1] + ' '
+                continue
+            line = logical_line + line
+            logical_line = ''
+            if len(line) == 0:
+                continue
+            if line.startswith(CFG.OR_SEP):
+                if lhs is None:
+                    raise Exception("%s:%d: alternatives without a rule to add them to" % (source, start_lineno))
+                rhs_str = line
+            else:
+                if CFG.LHS_RHS_SEP not in line:
+                    raise Exception("%s:%d: expected '%s' in '%s'" % (source, start_lineno, CFG.LHS_RHS_SEP, line))
+                (lhs, rhs_str) = [x.strip() for x in line.split(CFG.LHS_RHS_SEP, 1)]
+                if len(lhs) > 2 and lhs[0] == '<' and lhs[-1] == '>':
+                    lhs = lhs[1:-1]
+                if len(lhs) == 0 or len(lhs.split()) > 1:
+                    raise Exception("%s:%d: bad left hand side '%s'" % (source, start_lineno, lhs))
+                if lhs not in self.rules or len(self.rules[lhs]) == 0:
+                    self.rules[lhs] = []
+            for alt_str in rhs_str.split(CFG.OR_SEP):
+                tokens = alt_str.split()
+                if len(tokens) == 0:
+                    continue
+                alt = []
+                for token in tokens:
+                    if token == CFG.EPSILON:
+                        continue
+                    sym = parsed.get(token)
+                    if sym is None:
+                        sym = CFG.parse_symbol(token)
+                        parsed[token] = sym
+                        if not sym.is_terminal:
+                            first_use.setdefault(sym.val, start_lineno)
+                    alt.append(sym)
+                self.rules[lhs].append(alt)
+        if len(logical_line) > 0:
+            raise Exception("%s:%d: file ends with a continued line" % (source, start_lineno))
+        if validate:
+            undefined = [(n, first_use[n]) for n in first_use if n not in self.rules or len(self.rules[n]) == 0]
+            if len(undefined) > 0:
+                raise Exception("%s: undefined nonterminals: %s" %
+                                (source, ', '.join(["%s (line %d)" % u for u in sorted(undefined, key=lambda u: u[1])])))
+
+    def save_binary(self, filename):
+        """
+        Writes the grammar in the binary format read by load_binary (see MappedRules)
+        """
+        sym_ids = dict()
+        sym_vals = []
+        lhs, rule_alts, alt_syms, rhs = array('I'), array('I', [0]), array('I', [0]), array('I')
+
+        def intern(sym):
+            key = (sym.val, sym.is_terminal)
+            if key not in sym_ids:
+                sym_ids[key] = len(sym_vals)
+                sym_vals.append(key)
+            return sym_ids[key]
+
+        for k in self.rules.keys():
+            lhs.append(intern(Symbol(k, False)))
+            for alt in self.rules[k]:
+                rhs.extend(intern(sym) for sym in alt)
+                alt_syms.append(len(rhs))
+            rule_alts.append(len(alt_syms) - 1)
+        encoded = [val.encode('utf-8') for (val, _) in sym_vals]
+        sym_offsets = array('I', [0])
+        for e in encoded:
+            sym_offsets.append(sym_offsets[-1] + len(e))
+        terminal = bytes(1 if is_terminal else 0 for (_, is_terminal) in sym_vals)
+        blob = b''.join(encoded)
+        with open(filename, 'wb') as fh:
+            fh.write(MappedRules.HEADER.pack(MappedRules.MAGIC, MappedRules.VERSION, len(sym_vals), len(lhs),
+                                             len(alt_syms) - 1, len(rhs), len(blob)))
+            for ints in [lhs, rule_alts, alt_syms, rhs, sym_offsets]:
+                if sys.byteorder != 'little':
+                    ints.byteswap()
+                ints.tofile(fh)
+            fh.write(terminal)
+            fh.write(blob)
+
+    @staticmethod
+    def load_binary(filename):
+        """
+        Memory maps a grammar written by save_binary. rules are decoded lazily, on first lookup
+        """
+        cfg = CFG()
+        cfg.rules = MappedRules(filename)
+        return cfg
+
+    def compile(self, start=None, weights=None):
+        """
+        Builds integer tables for fast sampling (see CompiledCFG). every nonterminal used in a rhs must be defined
+        :param start: start symbol, CFG.START_SYMBOL by default
+        :param weights: optional dict of lhs -> one weight per alternative, in the order of self.rules[lhs]. defaults
+                        to the grammar's own weights, if it has any
+        :return: CompiledCFG
+        """
+        if weights is None and len(self.weights) > 0:
+            weights = self.weights
+        return CompiledCFG(self, CFG.START_SYMBOL if start is None else start, weights)
 
     def to_serializable(self):
         ser = dict()
@@ -153,14 +693,570 @@ class CFG:
         return cfg
 
 
+class CompiledCFG:
+    """
+    A CFG flattened into integer tables. nonterminal i (0 is the start symbol) has alternatives
+    nt_alts[i]..nt_alts[i+1]-1, and alternative j's rhs is rhs[alt_rhs[j]..alt_rhs[j+1]-1]. rhs entries are
+    nonterminal indexes, or ~t (i.e. negative) for terminal t. when weights are given, cum_weights holds the running
+    total of the weights within each nonterminal's alternatives, and alias_prob / alias_alt the alias tables (see
+    AliasTable) choose samples from, indexed by alternative
+    """
+
+    def __init__(self, grammar: CFG, start: str, weights=None):
+        if isinstance(grammar.rules, MappedRules) and not grammar.rules.modified:
+            # straight from the integer tables of the file, without turning any rule into Symbol lists
+            (self.nonterminals, self.terminals, alternatives, undefined) = grammar.rules.encode_reachable(start)
+        else:
+            (self.nonterminals, self.terminals, alternatives, undefined) = \
+                CompiledCFG.encode_reachable(grammar.rules, start)
+        if len(undefined) > 0:
+            raise Exception("Can't find %s in the rules" % ', '.join(undefined))
+        self.nt_alts = array('i', [0])
+        self.alt_rhs = array('i', [0])
+        self.rhs = array('i')
+        self.cum_weights = None if weights is None else []
+        self.alias_prob = None if weights is None else []
+        self.alias_alt = None if weights is None else array('i')
+        for i in range(len(self.nonterminals)):
+            for alt in alternatives[i]:
+                self.rhs.extend(alt)
+                self.alt_rhs.append(len(self.rhs))
+            self.nt_alts.append(len(self.alt_rhs) - 1)
+            if weights is not None:
+                self.add_weights(self.nonterminals[i], weights.get(self.nonterminals[i]), len(alternatives[i]))
+        # what the sampler actually walks: each alternative's rhs reversed, ready to be pushed onto a stack
+        self.rev_rhs = [tuple(reversed(self.rhs[self.alt_rhs[j]:self.alt_rhs[j + 1]]))
+                        for j in range(len(self.alt_rhs) - 1)]
+        self.first_alt = list(self.nt_alts[:-1])
+        self.num_alts = [self.nt_alts[i + 1] - self.nt_alts[i] for i in range(len(self.nonterminals))]
+        # filled in by analyze()
+        self.min_length = None
+        self.min_depth = None
+        self.alt_min_length = None
+        self.shortest_alt = None
+        self.termination_probability = None
+        self.expected_length = None
+
+    @staticmethod
+    def encode_reachable(rules, start):
+        """
+        :return: (nonterminals, terminals, the alternatives of each nonterminal as lists of rhs entries, names of
+                 the nonterminals without alternatives), for the nonterminals reachable from start in order of
+                 discovery
+        """
+        nonterminals = [start]
+        terminals = []
+        nt_ids = {start: 0}
+        t_ids = dict()
+        alternatives = []
+        undefined = []
+        i = 0
+        while i < len(nonterminals):
+            lhs = nonterminals[i]
+            alts = rules[lhs] if lhs in rules else []
+            if len(alts) == 0:
+                undefined.append(lhs)
+            encoded = []
+            for alt in alts:
+                enc = []
+                for sym in alt:
+                    if sym.is_terminal:
+                        t = t_ids.get(sym.val)
+                        if t is None:
+                            t = t_ids[sym.val] = len(terminals)
+                            terminals.append(sym.val)
+                        enc.append(~t)
+                    else:
+                        n = nt_ids.get(sym.val)
+                        if n is None:
+                            n = nt_ids[sym.val] = len(nonterminals)
+                            nonterminals.append(sym.val)
+                        enc.append(n)
+                encoded.append(enc)
+            alternatives.append(encoded)
+            i += 1
+        return nonterminals, terminals, alternatives, undefined
+
+    def add_weights(self, lhs, alt_weights, num_alts):
+        if alt_weights is None:
+            alt_weights = [1.0] * num_alts
+        if len(alt_weights) != num_alts or any(w < 0 for w in alt_weights) or sum(alt_weights) <= 0:
+            raise Exception("bad weights for %s" % lhs)
+        first = len(self.cum_weights)
+        total = 0.0
+        for w in alt_weights:
+            total += w
+            self.cum_weights.append(total)
+        (prob, alias) = AliasTable.build(alt_weights)
+        self.alias_prob.extend(prob)
+        self.alias_alt.extend(first + a for a in alias)
+
+    def alt_probabilities(self) -> list:
+        probs = []
+        for i in range(len(self.nonterminals)):
+            first = self.first_alt[i]
+            num_alts = self.num_alts[i]
+            if self.cum_weights is None:
+                probs.extend([1.0 / num_alts] * num_alts)
+            else:
+                total = self.cum_weights[first + num_alts - 1]
+                prev = 0.0
+                for j in range(first, first + num_alts):
+                    probs.append((self.cum_weights[j] - prev) / total)
+                    prev = self.cum_weights[j]
+        return probs
+
+    def analyze(self, max_iterations=10000, tolerance=1e-12):
+        """
+        Computes, for every nonterminal:
+            min_length:              fewest terminals it can derive (inf if it can't derive a terminal string)
+            min_depth:               height of its shallowest derivation tree (inf likewise)
+            termination_probability: probability that random expansion (with the alternative weights) ever ends
+            expected_length:         expected number of terminals it expands to. inf if that diverges, and also
+                                     whenever expansion may not terminate
+        plus alt_min_length per alternative and shortest_alt, the alternative leading to a shortest derivation.
+        shortest_alt breaks length ties by depth, so always following it is guaranteed to terminate.
+        the probabilities and expectations are least fixed points, found by iterating from 0. nonterminals are
+        solved one strongly connected component at a time, children first, so only the values inside a cycle are
+        iterated (at most max_iterations times) and the rest are exact after one evaluation. a warning is issued
+        when a termination probability, or the expected length of a nonterminal that terminates, doesn't settle
+        :return: self
+        """
+        inf = float('inf')
+        num_nts = len(self.nonterminals)
+        alts = range(len(self.alt_rhs) - 1)
+        children = [[s for s in self.rhs[self.alt_rhs[j]:self.alt_rhs[j + 1]] if s >= 0] for j in alts]
+        num_terminals = [self.alt_rhs[j + 1] - self.alt_rhs[j] - len(children[j]) for j in alts]
+        nt_alts = [range(self.first_alt[i], self.first_alt[i] + self.num_alts[i]) for i in range(num_nts)]
+        successors = [set(c for j in nt_alts[i] for c in children[j]) for i in range(num_nts)]
+        components = [(members, len(members) > 1 or members[0] in successors[members[0]])
+                      for members in CompiledCFG.components(successors)]
+        # (length, depth) of the shortest derivations, and plain minimum depth
+        shortest = [(inf, inf)] * num_nts
+        self.min_depth = [inf] * num_nts
+        self.shortest_alt = [-1] * num_nts
+        for (members, cyclic) in components:
+            changed = True
+            while changed:
+                changed = False
+                for i in members:
+                    for j in nt_alts[i]:
+                        key = (num_terminals[j] + sum(shortest[c][0] for c in children[j]),
+                               1 + max([shortest[c][1] for c in children[j]], default=0))
+                        if key < shortest[i]:
+                            shortest[i] = key
+                            self.shortest_alt[i] = j
+                            changed = True
+                        depth = 1 + max([self.min_depth[c] for c in children[j]], default=0)
+                        if depth < self.min_depth[i]:
+                            self.min_depth[i] = depth
+                            changed = True
+                changed = changed and cyclic
+        self.min_length = [key[0] for key in shortest]
+        self.alt_min_length = [num_terminals[j] + sum(self.min_length[c] for c in children[j]) for j in alts]
+        probs = self.alt_probabilities()
+        (self.termination_probability, settled) = self.least_fixed_point(
+            lambda q, j: probs[j] * CompiledCFG.product([q[c] for c in children[j]]),
+            nt_alts, successors, components, max_iterations, tolerance)
+        if not all(settled):
+            warnings.warn("termination probabilities of %d nonterminals did not settle within %d iterations" %
+                          (settled.count(False), max_iterations))
+        (expected, settled) = self.least_fixed_point(
+            lambda e, j: probs[j] * (num_terminals[j] + sum(e[c] for c in children[j])),
+            nt_alts, successors, components, max_iterations, tolerance)
+        self.expected_length = [e if ok and q > 1 - 1e-6 else inf
+                                for e, ok, q in zip(expected, settled, self.termination_probability)]
+        num_unsettled = sum(1 for ok, q in zip(settled, self.termination_probability) if not ok and q > 1 - 1e-6)
+        if num_unsettled > 0:
+            warnings.warn("expected lengths of %d nonterminals did not settle within %d iterations and are given as inf"
+                          % (num_unsettled, max_iterations))
+        return self
+
+    @staticmethod
+    def product(values):
+        p = 1.0
+        for v in values:
+            p *= v
+        return p
+
+    @staticmethod
+    def components(successors) -> list:
+        """
+        Strongly connected components of a graph, by Tarjan's algorithm with an explicit stack
+        :param successors: node -> nodes it has edges to, for nodes 0 .. len(successors) - 1
+        :return: list of components, each a list of nodes. a component comes after every component it has edges to
+        """
+        n = len(successors)
+        index = [-1] * n
+        low = [0] * n
+        on_stack = [False] * n
+        stack = []
+        result = []
+        count = 0
+        for root in range(n):
+            if index[root] >= 0:
+                continue
+            index[root] = low[root] = count
+            count += 1
+            stack.append(root)
+            on_stack[root] = True
+            # nodes being visited, with their edges still to follow
+            work = [(root, iter(successors[root]))]
+            while len(work) > 0:
+                (v, edges) = work[-1]
+                for w in edges:
+                    if index[w] < 0:
+                        index[w] = low[w] = count
+                        count += 1
+                        stack.append(w)
+                        on_stack[w] = True
+                        work.append((w, iter(successors[w])))
+                        break
+                    if on_stack[w]:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+                    if len(work) > 0:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+                    if low[v] == index[v]:
+                        component = []
+                        while True:
+                            w = stack.pop()
+                            on_stack[w] = False
+                            component.append(w)
+                            if w == v:
+                                break
+                        result.append(component)
+        return result
+
+    @staticmethod
+    def least_fixed_point(alt_value, nt_alts, successors, components, max_iterations, tolerance):
+        # solves x[i] = sum of alt_value(x, j) over i's alternatives j from x = 0, one component at a time in the
+        # order given (children first). a component without a cycle is exact after one evaluation, a cyclic one is
+        # updated in place until a whole pass leaves it unchanged. returns the values and, per nonterminal, whether
+        # it settled within max_iterations, which also takes every nonterminal it depends on having settled
+        x = [0.0] * len(nt_alts)
+        settled = [True] * len(nt_alts)
+        for (members, cyclic) in components:
+            for _ in range(max_iterations if cyclic else 1):
+                unchanged = True
+                for i in members:
+                    v = sum(alt_value(x, j) for j in nt_alts[i])
+                    if v != x[i] and abs(v - x[i]) > tolerance * max(1.0, abs(v)):
+                        unchanged = False
+                    x[i] = v
+                if unchanged:
+                    break
+            ok = (unchanged or not cyclic) and all(settled[c] for i in members for c in successors[i])
+            for i in members:
+                settled[i] = ok
+        return x, settled
+
+    def derivation_stats(self) -> dict:
+        """
+        :return: nonterminal -> dict of the values computed by analyze()
+        """
+        if self.min_length is None:
+            self.analyze()
+        return dict((nt, {'min_length': self.min_length[i], 'min_depth': self.min_depth[i],
+                          'termination_probability': self.termination_probability[i],
+                          'expected_length': self.expected_length[i]})
+                    for i, nt in enumerate(self.nonterminals))
+
+    def choose(self, nt, rng) -> int:
+        first = self.first_alt[nt]
+        num_alts = self.num_alts[nt]
+        if num_alts == 1:
+            return first
+        x = rng.random() * num_alts
+        i = min(int(x), num_alts - 1)
+        if self.alias_prob is None:
+            return first + i
+        return first + i if x - i < self.alias_prob[first + i] else self.alias_alt[first + i]
+
+    def sample(self, rng=random) -> list:
+        """
+        :return: terminal ids of one random derivation of the start symbol
+        """
+        rev_rhs = self.rev_rhs
+        choose = self.choose
+        out = []
+        # symbols still to expand, the next one on top. popping the leftmost symbol first keeps the derivation in
+        # the same depth first, left to right order as CFG.expand
+        stack = list(rev_rhs[choose(0, rng)])
+        while len(stack) > 0:
+            sym = stack.pop()
+            if sym < 0:
+                out.append(~sym)
+            else:
+                stack.extend(rev_rhs[choose(sym, rng)])
+        return out
+
+    def sample_bounded(self, max_length, rng=random, max_steps=None) -> list:
+        """
+        Like sample, but the sentence is never longer than max_length terminals (or the start symbol's min_length,
+        if that is larger). the terminals already produced plus the fewest the stack can still expand to are kept
+        up to date, and whenever the random alternative would push that past max_length the nonterminal's
+        shortest_alt is taken instead, a constant time check per expansion.
+        that alone doesn't bound the number of steps: expansions that add no terminals (unit or empty cycles such
+        as A -> A A | ε) never hit the length bound. so after max_steps expansions (100 * (max_length + 1) by
+        default) every remaining nonterminal takes its shortest_alt, which always finishes, within at most the sum
+        of the min_depth derivations of what is left on the stack
+        """
+        if self.min_length is None:
+            self.analyze()
+        if self.min_length[0] == float('inf'):
+            raise Exception("%s can't derive a finite sentence" % self.nonterminals[0])
+        if max_steps is None:
+            max_steps = 100 * (max_length + 1)
+        rev_rhs = self.rev_rhs
+        choose = self.choose
+        min_length = self.min_length
+        alt_min_length = self.alt_min_length
+        shortest_alt = self.shortest_alt
+        out = []
+        stack = [0]
+        # terminals out plus min_length of everything on the stack
+        committed = min_length[0]
+        steps = 0
+        while len(stack) > 0:
+            sym = stack.pop()
+            if sym < 0:
+                out.append(~sym)
+                continue
+            steps += 1
+            if steps > max_steps:
+                stack.extend(rev_rhs[shortest_alt[sym]])
+                continue
+            j = choose(sym, rng)
+            extra = alt_min_length[j] - min_length[sym]
+            if committed + extra > max_length:
+                j = shortest_alt[sym]
+                extra = 0
+            committed += extra
+            stack.extend(rev_rhs[j])
+        return out
+
+    def decode(self, terminal_ids) -> list:
+        return [self.terminals[t] for t in terminal_ids]
+
+    def generate_many(self, n, rng=None, max_length=None) -> list:
+        """
+        Same as CFG.generate_many without trees, using the compiled tables
+        :param max_length: if given, sentences are generated with sample_bounded
+        """
+        if rng is None:
+            rng = random
+        elif isinstance(rng, int):
+            rng = random.Random(rng)
+        terminals = self.terminals
+        if max_length is None:
+            return [{'flat': ' '.join([terminals[t] for t in self.sample(rng)])} for _ in range(n)]
+        return [{'flat': ' '.join([terminals[t] for t in self.sample_bounded(max_length, rng)])} for _ in range(n)]
+
+    def expansion_cache(self, max_symbols=1000000, max_expansions=1000):
+        return ExpansionCache(self, max_symbols, max_expansions)
+
+
+class ExpansionCache:
+    """
+    Finite languages of the acyclic nonterminals of a CompiledCFG (those that can't reach themselves, such as the
+    chains MetaGrammar builds), so a whole subtree can be sampled with one lookup instead of being expanded symbol
+    by symbol. a nonterminal's entry holds every distinct expansion (as a tuple of terminal ids) with its
+    probability under the grammar's weights, and an AliasTable over them, so sampling through the cache gives the
+    same distribution as CompiledCFG.sample.
+
+    entries are built on first use from the entries of their children. nonterminals with more than max_expansions
+    derivations, or whose derivations hold more than max_symbols terminal ids between them, are never cached, and
+    the least recently used entries are dropped once more than max_symbols terminal ids are held
+    """
+
+    def __init__(self, compiled: CompiledCFG, max_symbols=1000000, max_expansions=1000):
+        self.compiled = compiled
+        self.max_symbols = max_symbols
+        self.max_expansions = max_expansions
+        self.entries = collections.OrderedDict()
+        self.num_symbols = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        num_nts = len(compiled.nonterminals)
+        self.alt_probs = compiled.alt_probabilities()
+        # number of derivations of each acyclic nonterminal and the terminal ids they hold between them (an upper
+        # bound on the size of its entry), both capped, None for the others. a nonterminal is acyclic once all of
+        # its children are, so the ones on or above a cycle never get a count
+        self.num_derivations = [None] * num_nts
+        self.derivation_symbols = [None] * num_nts
+        cap = max_expansions + 1
+        symbol_cap = max_symbols + 1
+        changed = True
+        while changed:
+            changed = False
+            for i in reversed(range(num_nts)):
+                if self.num_derivations[i] is not None:
+                    continue
+                total = 0
+                total_symbols = 0
+                for j in range(compiled.first_alt[i], compiled.first_alt[i] + compiled.num_alts[i]):
+                    count = 1
+                    symbols = 0
+                    for c in compiled.rhs[compiled.alt_rhs[j]:compiled.alt_rhs[j + 1]]:
+                        if c < 0:
+                            symbols = min(symbols + count, symbol_cap)
+                            continue
+                        if self.num_derivations[c] is None:
+                            total = None
+                            break
+                        symbols = min(symbols * self.num_derivations[c] + self.derivation_symbols[c] * count,
+                                      symbol_cap)
+                        count = min(count * self.num_derivations[c], cap)
+                    if total is None:
+                        break
+                    total = min(total + count, cap)
+                    total_symbols = min(total_symbols + symbols, symbol_cap)
+                if total is not None:
+                    self.num_derivations[i] = total
+                    self.derivation_symbols[i] = total_symbols
+                    changed = True
+        self.cacheable = [n is not None and n <= max_expansions and self.derivation_symbols[i] <= max_symbols
+                          for i, n in enumerate(self.num_derivations)]
+
+    def lookup(self, nt):
+        """
+        :return: (expansions, their probabilities, AliasTable) for nt, or None if nt is not cacheable
+        """
+        entry = self.entries.get(nt)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(nt)
+            return entry
+        if not self.cacheable[nt]:
+            return None
+        return self.build(nt)
+
+    def add(self, nt, entry):
+        # caches entry as the most recently used and evicts the least recently used ones past max_symbols
+        self.misses += 1
+        self.entries[nt] = entry
+        self.num_symbols += sum(len(e) for e in entry[0])
+        while self.num_symbols > self.max_symbols and len(self.entries) > 1:
+            (_, (old, _, _)) = self.entries.popitem(last=False)
+            self.num_symbols -= sum(len(e) for e in old)
+            self.evictions += 1
+
+    def build(self, nt):
+        """
+        Builds the entries of nt and of its descendants that aren't cached yet, children before parents, with an
+        explicit stack so long chains don't run into the recursion limit. each entry is cached as soon as it is
+        built, so the cache never holds more than max_symbols terminal ids. built keeps the entries a pending
+        parent still needs (an eviction can't take them from it) and lets go of each once its last parent is built,
+        so besides the cache only the entries along the current path are held
+        :return: nt's entry
+        """
+        c = self.compiled
+        built = dict()
+        # child -> number of pending parents that use it
+        needed = dict()
+        expanded = set()
+        stack = [nt]
+        while len(stack) > 0:
+            top = stack[-1]
+            if top in built:
+                stack.pop()
+                continue
+            children = set(s for s in c.rhs[c.alt_rhs[c.first_alt[top]]:c.alt_rhs[c.first_alt[top] + c.num_alts[top]]]
+                           if s >= 0)
+            if top not in expanded:
+                expanded.add(top)
+                for s in children:
+                    needed[s] = needed.get(s, 0) + 1
+            # a child cached before this build started may have been evicted since, and is built again
+            missing = [s for s in children if s not in built and s not in self.entries]
+            if len(missing) > 0:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            entry = self.build_entry(top, built)
+            for s in children:
+                needed[s] -= 1
+                if needed[s] == 0:
+                    built.pop(s, None)
+            if needed.get(top, 0) > 0:
+                built[top] = entry
+            self.add(top, entry)
+        return entry
+
+    def build_entry(self, nt, built):
+        c = self.compiled
+        probs = dict()
+        for j in range(c.first_alt[nt], c.first_alt[nt] + c.num_alts[nt]):
+            partial = {(): self.alt_probs[j]}
+            for sym in c.rhs[c.alt_rhs[j]:c.alt_rhs[j + 1]]:
+                if sym < 0:
+                    partial = dict((prefix + (~sym,), p) for prefix, p in partial.items())
+                    continue
+                child = built.get(sym)
+                if child is None:
+                    child = self.entries[sym]
+                    self.hits += 1
+                    self.entries.move_to_end(sym)
+                (child_exps, child_probs, _) = child
+                extended = dict()
+                for prefix, p in partial.items():
+                    for exp, q in zip(child_exps, child_probs):
+                        key = prefix + exp
+                        extended[key] = extended.get(key, 0.0) + p * q
+                partial = extended
+            for exp, p in partial.items():
+                probs[exp] = probs.get(exp, 0.0) + p
+        return tuple(probs.keys()), tuple(probs.values()), AliasTable(list(probs.values()))
+
+    def sample(self, rng=random) -> list:
+        """
+        Same as CompiledCFG.sample, but cached nonterminals are expanded with one lookup
+        """
+        rev_rhs = self.compiled.rev_rhs
+        choose = self.compiled.choose
+        cacheable = self.cacheable
+        out = []
+        stack = [0]
+        while len(stack) > 0:
+            sym = stack.pop()
+            if sym < 0:
+                out.append(~sym)
+            elif cacheable[sym]:
+                (expansions, _, table) = self.lookup(sym)
+                out.extend(expansions[table.sample(rng)])
+            else:
+                stack.extend(rev_rhs[choose(sym, rng)])
+        return out
+
+    def memory_report(self) -> dict:
+        """
+        :return: entry and expansion counts, terminal ids held, an estimate of the bytes used (sys.getsizeof of the
+                 tuples and tables, not counting the small ints they share) and the hit, miss and eviction counts
+        """
+        num_bytes = sys.getsizeof(self.entries)
+        num_expansions = 0
+        for (expansions, probs, table) in self.entries.values():
+            num_expansions += len(expansions)
+            num_bytes += sys.getsizeof(expansions) + sum(sys.getsizeof(e) for e in expansions)
+            # the probabilities are floats of their own, 24 bytes each, held twice: in probs and in table.prob
+            num_bytes += sys.getsizeof(probs) + sys.getsizeof(table.prob) + sys.getsizeof(table.alias) + \
+                2 * 24 * len(probs)
+        return {'entries': len(self.entries), 'expansions': num_expansions, 'symbols': self.num_symbols,
+                'bytes': num_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'cacheable_nonterminals': sum(self.cacheable)}
+
+
 if __name__ == '__main__':
     cfg = CFG()
     cfg.load('resources/simplegrammar.cfg')
     num_sentences = 20
     fh = open('./cfg_generated_sentences.txt', 'w')
     gen = cfg.generate()
-    print(gen.flat)
-    str = '. '.join([' '.join(cfg.generate()['flat']) for _ in range(10)]) + "."
-    fh.write(str)
+    print(gen['flat'])
+    fh.write('. '.join([g['flat'] for g in cfg.generate_many(num_sentences)]) + ".")
     fh.close()
     print('write %d random sentences' % num_sentences)
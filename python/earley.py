@@ -0,0 +1,442 @@
+import os
+import sys
+from collections import deque
+import multiprocessing
+from cfg import CFG
+
+
+class ParseForest:
+    """
+    All parses of a sentence, packed: nodes maps (nonterminal, begin, end) -> list of derivations, each an
+    (alternative index, children) pair where a child is either the key of another node or a terminal value.
+    subtrees shared by several parses are stored once
+    """
+
+    def __init__(self, root, nodes):
+        self.root = root
+        self.nodes = nodes
+        # node -> position in which it was found to have a finite derivation, see finite_order
+        self.order = None
+
+    def is_ambiguous(self) -> bool:
+        return any(len(derivations) > 1 for derivations in self.nodes.values())
+
+    def finite_order(self) -> dict:
+        """
+        :return: node -> rank, for the nodes that have a finite derivation (one that does not loop through unit or
+                 empty cycles). a node gets its rank once all child nodes of one of its derivations have one, so
+                 every ranked node has a derivation whose child nodes all rank lower
+        """
+        if self.order is not None:
+            return self.order
+        # (node, derivation index) -> child nodes still without a rank, and child node -> derivations waiting on it
+        pending = dict()
+        waiting = dict()
+        queue = deque()
+        for key, derivations in self.nodes.items():
+            for d, (_, children) in enumerate(derivations):
+                child_nodes = [c for c in children if isinstance(c, tuple)]
+                if len(child_nodes) == 0:
+                    queue.append(key)
+                    continue
+                pending[(key, d)] = len(child_nodes)
+                for c in child_nodes:
+                    waiting.setdefault(c, []).append((key, d))
+        self.order = dict()
+        while len(queue) > 0:
+            key = queue.popleft()
+            if key in self.order:
+                continue
+            self.order[key] = len(self.order)
+            for derivation in waiting.get(key, ()):
+                pending[derivation] -= 1
+                if pending[derivation] == 0:
+                    queue.append(derivation[0])
+        return self.order
+
+    def tree(self, key=None, used=None):
+        """
+        :param used: if a list is given, the (nonterminal, alternative index) of every expansion in the parse is
+                     appended to it
+        :return: one parse as nested (nonterminal, [children]) tuples, terminals as plain values. each node takes its
+                 first derivation whose child nodes all rank lower in finite_order, so unit or empty cycles are
+                 never followed. built with an explicit stack of (nonterminal, remaining children, built children),
+                 so deep parses do not hit the recursion limit
+        """
+        key = self.root if key is None else key
+        if key not in self.finite_order():
+            raise Exception("no finite derivation of %s" % str(key))
+        stack = [(key[0], iter(self.finite_derivation(key, used)), [])]
+        while True:
+            (name, children, built) = stack[-1]
+            for c in children:
+                if isinstance(c, tuple):
+                    stack.append((c[0], iter(self.finite_derivation(c, used)), []))
+                    break
+                built.append(c)
+            else:
+                stack.pop()
+                if len(stack) == 0:
+                    return name, built
+                stack[-1][2].append((name, built))
+
+    def finite_derivation(self, key, used=None):
+        """
+        :return: the children of the first derivation of key whose child nodes all rank lower in finite_order. its
+                 (nonterminal, alternative index) is appended to used if given
+        """
+        order = self.finite_order()
+        rank = order[key]
+        for (alt, children) in self.nodes[key]:
+            if all(order.get(c, rank) < rank for c in children if isinstance(c, tuple)):
+                if used is not None:
+                    used.append((key[0], alt))
+                return children
+
+    def inside(self, alt_prob, max_iterations=100) -> float:
+        """
+        Total probability of all parses
+        :param alt_prob: function (nonterminal, alternative index) -> probability of that alternative
+        :return: probability of the sentence. nodes are evaluated from short spans to long ones; nodes of the same
+                 span can depend on each other through unit or empty cycles and are iterated until they settle
+        """
+        probs = dict((key, 0.0) for key in self.nodes)
+        by_span = dict()
+        for key in self.nodes:
+            by_span.setdefault(key[2] - key[1], []).append(key)
+        for span in sorted(by_span.keys()):
+            keys = by_span[span]
+            for _ in range(max_iterations):
+                changed = False
+                for key in keys:
+                    p = 0.0
+                    for (alt, children) in self.nodes[key]:
+                        q = alt_prob(key[0], alt)
+                        for c in children:
+                            if isinstance(c, tuple):
+                                q *= probs[c]
+                        p += q
+                    if abs(p - probs[key]) > 1e-15 * max(p, 1e-300):
+                        probs[key] = p
+                        changed = True
+                if not changed:
+                    break
+        return probs[self.root]
+
+
+class EarleyParser:
+    """
+    Earley recognizer and parser over the integer tables of CFG.compile. handles any CFG, including left recursion,
+    empty alternatives and ambiguity.
+
+    every dotted rule gets a number: alternative j's dots are alt_rhs[j]+j .. alt_rhs[j+1]+j, so advancing the dot
+    is +1, and an item (dot, origin) is stored as origin * num_dots + dot. built once per grammar:
+        nullable:  which nonterminals derive the empty string. predicting a nullable nonterminal immediately also
+                   advances over it (Aycock and Horspool), so completions never have to be revisited
+        predict:   for each nonterminal and next token, the start dots of every alternative reachable through left
+                   corners (including past nullable prefixes) that could begin with that token or is nullable.
+                   a prediction adds all of them at once and marks the whole left corner closure as predicted
+    """
+
+    def __init__(self, grammar: CFG, start=None):
+        self.compiled = grammar.compile(start)
+        c = self.compiled
+        num_nts = len(c.nonterminals)
+        num_alts = len(c.alt_rhs) - 1
+        self.terminal_ids = dict((t, i) for i, t in enumerate(c.terminals))
+        self.alt_lhs = [i for i in range(num_nts) for _ in range(c.num_alts[i])]
+        self.num_dots = len(c.rhs) + num_alts
+        # symbol after each dot (nonterminal index or ~terminal), None once the alternative is complete
+        self.next_sym = []
+        self.dot_lhs = []
+        self.start_dots = []
+        for j in range(num_alts):
+            self.start_dots.append(len(self.next_sym))
+            self.next_sym.extend(c.rhs[c.alt_rhs[j]:c.alt_rhs[j + 1]])
+            self.next_sym.append(None)
+            self.dot_lhs.extend([self.alt_lhs[j]] * (c.alt_rhs[j + 1] - c.alt_rhs[j] + 1))
+        self.dot_alt = [j for j in range(num_alts) for _ in range(c.alt_rhs[j + 1] - c.alt_rhs[j] + 1)]
+        self.nullable = self.find_nullable()
+        self.closure = self.find_left_corners()
+        (self.predict, self.predict_nullable) = self.build_prediction_table()
+        self.accept_dots = frozenset(self.start_dots[j] + c.alt_rhs[j + 1] - c.alt_rhs[j]
+                                     for j in range(c.nt_alts[0], c.nt_alts[1]))
+
+    def alt_symbols(self, j):
+        return self.compiled.rhs[self.compiled.alt_rhs[j]:self.compiled.alt_rhs[j + 1]]
+
+    def find_nullable(self) -> list:
+        nullable = [False] * len(self.compiled.nonterminals)
+        changed = True
+        while changed:
+            changed = False
+            for j in range(len(self.alt_lhs)):
+                if not nullable[self.alt_lhs[j]] and all(s >= 0 and nullable[s] for s in self.alt_symbols(j)):
+                    nullable[self.alt_lhs[j]] = True
+                    changed = True
+        return nullable
+
+    def find_left_corners(self) -> list:
+        # nonterminals that can appear first in a derivation of each nonterminal, itself included
+        direct = [set() for _ in self.compiled.nonterminals]
+        for j in range(len(self.alt_lhs)):
+            for s in self.alt_symbols(j):
+                if s < 0:
+                    break
+                direct[self.alt_lhs[j]].add(s)
+                if not self.nullable[s]:
+                    break
+        closure = []
+        for i in range(len(direct)):
+            seen = {i}
+            stack = [i]
+            while len(stack) > 0:
+                for b in direct[stack.pop()]:
+                    if b not in seen:
+                        seen.add(b)
+                        stack.append(b)
+            closure.append(frozenset(seen))
+        return closure
+
+    def alt_first_terminals(self) -> list:
+        # terminals that can begin each alternative, found by fixpoint over the nonterminals' first sets
+        first = [set() for _ in self.compiled.nonterminals]
+        alt_first = [set() for _ in self.alt_lhs]
+        changed = True
+        while changed:
+            changed = False
+            for j in range(len(self.alt_lhs)):
+                for s in self.alt_symbols(j):
+                    if s < 0:
+                        alt_first[j].add(~s)
+                        break
+                    alt_first[j] |= first[s]
+                    if not self.nullable[s]:
+                        break
+                lhs_first = first[self.alt_lhs[j]]
+                if not alt_first[j] <= lhs_first:
+                    lhs_first |= alt_first[j]
+                    changed = True
+        return alt_first
+
+    def build_prediction_table(self):
+        c = self.compiled
+        alt_first = self.alt_first_terminals()
+        alt_nullable = [all(s >= 0 and self.nullable[s] for s in self.alt_symbols(j)) for j in range(len(self.alt_lhs))]
+        predict = []
+        predict_nullable = []
+        for i in range(len(c.nonterminals)):
+            alts = [j for b in sorted(self.closure[i]) for j in range(c.nt_alts[b], c.nt_alts[b + 1])]
+            nullable_alts = [j for j in alts if alt_nullable[j]]
+            by_token = dict()
+            for j in alts:
+                for t in alt_first[j]:
+                    by_token.setdefault(t, []).append(j)
+            predict.append(dict((t, tuple(self.start_dots[j] for j in sorted(set(js) | set(nullable_alts))))
+                                for t, js in by_token.items()))
+            predict_nullable.append(tuple(self.start_dots[j] for j in nullable_alts))
+        return predict, predict_nullable
+
+    def encode(self, tokens):
+        ids = []
+        for tok in tokens:
+            t = self.terminal_ids.get(tok)
+            if t is None:
+                return None
+            ids.append(t)
+        return ids
+
+    def chart(self, ids, completed=None) -> list:
+        """
+        Runs the Earley passes over a sentence of terminal ids
+        :param completed: if a set is given, every completed (alternative, begin, end) is added to it
+        :return: the set of items of every column
+        """
+        n = len(ids)
+        num_dots = self.num_dots
+        next_sym = self.next_sym
+        dot_lhs = self.dot_lhs
+        nullable = self.nullable
+        closure = self.closure
+        predict = self.predict
+        predict_nullable = self.predict_nullable
+        columns = [set() for _ in range(n + 1)]
+        # per column: nonterminal -> items waiting for it
+        waiting = [None] * (n + 1)
+        agenda = [self.predict_start(ids)]
+        columns[0].update(agenda[0])
+        for i in range(n + 1):
+            seen = columns[i]
+            items = agenda[i]
+            wait_i = dict()
+            waiting[i] = wait_i
+            predicted = set(closure[0]) if i == 0 else set()
+            tok = ids[i] if i < n else None
+            scanned = []
+            k = 0
+            while k < len(items):
+                item = items[k]
+                k += 1
+                dot = item % num_dots
+                s = next_sym[dot]
+                if s is None:
+                    origin = item // num_dots
+                    lhs = dot_lhs[dot]
+                    if completed is not None:
+                        completed.add((self.dot_alt[dot], origin, i))
+                    for w in waiting[origin].get(lhs, ()):
+                        if w + 1 not in seen:
+                            seen.add(w + 1)
+                            items.append(w + 1)
+                elif s >= 0:
+                    wait_i.setdefault(s, []).append(item)
+                    if nullable[s] and item + 1 not in seen:
+                        seen.add(item + 1)
+                        items.append(item + 1)
+                    if s not in predicted:
+                        predicted |= closure[s]
+                        base = i * num_dots
+                        for d in (predict_nullable[s] if tok is None else predict[s].get(tok, predict_nullable[s])):
+                            if base + d not in seen:
+                                seen.add(base + d)
+                                items.append(base + d)
+                elif ~s == tok:
+                    scanned.append(item + 1)
+            if i < n:
+                if len(scanned) == 0:
+                    return columns[:i + 1]
+                columns[i + 1].update(scanned)
+                agenda.append(list(columns[i + 1]))
+        return columns
+
+    def predict_start(self, ids) -> list:
+        tok = ids[0] if len(ids) > 0 else None
+        return list(self.predict_nullable[0] if tok is None else self.predict[0].get(tok, self.predict_nullable[0]))
+
+    def recognize(self, tokens) -> bool:
+        """
+        :param tokens: sequence of terminal values
+        :return: whether the grammar generates the sentence
+        """
+        ids = self.encode(tokens)
+        if ids is None:
+            return False
+        columns = self.chart(ids)
+        return len(columns) == len(ids) + 1 and not self.accept_dots.isdisjoint(columns[-1])
+
+    def parse(self, tokens):
+        """
+        :param tokens: sequence of terminal values
+        :return: ParseForest of all parses, None if the sentence is not in the language
+        """
+        ids = self.encode(tokens)
+        if ids is None:
+            return None
+        completed = set()
+        columns = self.chart(ids, completed)
+        if len(columns) != len(ids) + 1 or self.accept_dots.isdisjoint(columns[-1]):
+            return None
+        return self.build_forest(ids, completed)
+
+    def build_forest(self, ids, completed) -> ParseForest:
+        c = self.compiled
+        # (nonterminal, begin) -> ends of its completed spans, and (nonterminal, begin, end) -> alternatives
+        ends = dict()
+        span_alts = dict()
+        for (j, b, e) in completed:
+            a = self.alt_lhs[j]
+            ends.setdefault((a, b), set()).add(e)
+            span_alts.setdefault((a, b, e), []).append(j)
+        root = (0, 0, len(ids))
+        nodes = dict()
+        stack = [root]
+        while len(stack) > 0:
+            key = stack.pop()
+            if key in nodes:
+                continue
+            (a, b, e) = key
+            derivations = []
+            for j in sorted(span_alts[key]):
+                for children in self.split(self.alt_symbols(j), b, e, ids, ends):
+                    derivations.append((j - c.nt_alts[a], children))
+                    stack.extend(ch for ch in children if isinstance(ch, tuple) and ch not in nodes)
+            nodes[key] = derivations
+        names = c.nonterminals
+
+        def named(k):
+            return (names[k[0]], k[1], k[2]) if isinstance(k, tuple) else c.terminals[k]
+        return ParseForest(named(root), dict((named(key), [(alt, [named(ch) for ch in children])
+                                                           for (alt, children) in derivations])
+                                             for key, derivations in nodes.items()))
+
+    @staticmethod
+    def split(syms, begin, end, ids, ends):
+        # every way of dividing begin..end between the symbols of an alternative. terminals are given as their id
+        results = []
+        stack = [(0, begin, [])]
+        while len(stack) > 0:
+            (k, pos, children) = stack.pop()
+            if k == len(syms):
+                if pos == end:
+                    results.append(children)
+                continue
+            s = syms[k]
+            if s < 0:
+                if pos < end and ids[pos] == ~s:
+                    stack.append((k + 1, pos + 1, children + [~s]))
+            else:
+                for e in ends.get((s, pos), ()):
+                    if e <= end:
+                        stack.append((k + 1, e, children + [(s, pos, e)]))
+        return results
+
+
+# each pool worker builds its parser once
+_worker_parser = None
+
+
+def init_worker(rules, start):
+    global _worker_parser
+    _worker_parser = EarleyParser(CFG.from_dict(rules), start)
+
+
+def parse_chunk(args):
+    (sentences, want_forest) = args
+    if want_forest:
+        return [_worker_parser.parse(s) for s in sentences]
+    return [_worker_parser.recognize(s) for s in sentences]
+
+
+def parse_corpus(grammar: CFG, sentences: list, start=None, processes=None, want_forest=False, chunk_size=500,
+                 start_method=None):
+    """
+    Recognizes (or parses) a corpus on a process pool
+    :param sentences: list of sentences, each a list of terminal values
+    :param processes: size of the process pool (defaults to the number of cores). 1 runs in this process
+    :param want_forest: return a ParseForest (or None) per sentence instead of a bool
+    :param start_method: multiprocessing start method ('fork', 'spawn', ...), the platform's default if None
+    :return: one result per sentence, in corpus order
+    """
+    # CFG.rules is a defaultdict with a lambda factory, which can't be pickled, so workers get a plain dict of the
+    # rules (symbols pickle fine) and build their own CFG
+    rules = dict((lhs, grammar.rules[lhs]) for lhs in grammar.rules.keys())
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1:
+        init_worker(rules, start)
+        return parse_chunk((sentences, want_forest))
+    chunks = [(sentences[i:i + chunk_size], want_forest) for i in range(0, len(sentences), chunk_size)]
+    context = multiprocessing.get_context(start_method)
+    with context.Pool(processes, initializer=init_worker, initargs=(rules, start)) as pool:
+        results = pool.map(parse_chunk, chunks)
+    return [r for chunk in results for r in chunk]
+
+
+if __name__ == '__main__':
+    # grammar file, then one sentence per line on stdin
+    cfg = CFG()
+    cfg.load(sys.argv[1])
+    parser = EarleyParser(cfg, sys.argv[2] if len(sys.argv) > 2 else None)
+    for line in sys.stdin:
+        forest = parser.parse(line.split())
+        print("%s\t%s" % ('-' if forest is None else str(forest.tree()), line.strip()))
@@ -2,7 +2,8 @@ from cfg import CFG, Symbol
 import json
 import sys
 import string
-from collections import defaultdict
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
 import re
 import nltk
 
@@ -26,6 +27,7 @@ class PatternTemplate:
     id_num = 0
     pt_id = 0
     WILDCARD = '*'
+    WILDCARD_SYMBOL = Symbol(WILDCARD, True)
 
     def __init__(self, pattern_def_string: str, is_available=False) -> object:
         self.pattern_def_string = pattern_def_string
@@ -75,13 +77,13 @@ class PatternTemplate:
 
     def symbol_matches_current_slot(self, symbol: Symbol):
         slot_val = self.vars[self.slots[self.current_slot_position]]
-        return slot_val == symbol or slot_val == Symbol(PatternTemplate.WILDCARD, True)
+        return slot_val == symbol or slot_val == PatternTemplate.WILDCARD_SYMBOL
 
     def at_last_slot(self):
         return (len(self.slots) - 1) == self.current_slot_position
 
     def symbol_already_exists(self, symbol):
-        return symbol in [self.vars[k] for k in self.vars.keys()]
+        return symbol in self.vars.values()
 
     def consume_next(self, sym):
         # note that this needs to be checked before binding
@@ -131,9 +133,14 @@ class PatternTemplate:
 
 
 class GrammarPosition:
+    """
+    Where a match was found: rhs_begin..rhs_end (inclusive) of alternative alt of rule lhs. alt is None when the
+    caller didn't say which alternative, and then all such positions of a rule count as the same rhs
+    """
 
-    def __init__(self, lhs, rhs_beg, rhs_end):
+    def __init__(self, lhs, rhs_beg, rhs_end, alt=None):
         self.lhs = lhs
+        self.alt = alt
         self.rhs_begin = rhs_beg
         self.rhs_end = rhs_end
 
@@ -141,21 +148,43 @@ class GrammarPosition:
         return "@%s(%d, %d)" % (self.lhs, self.rhs_begin, self.rhs_end)
 
     def __eq__(self, other):
-        same_position = self.rhs_begin == other.rhs_begin and self.rhs_end == other.rhs_end
-        overlapped_positions = (self.rhs_begin <= other.rhs_begin <= self.rhs_end) or \
-                               (self.rhs_begin <= other.rhs_end <= self.rhs_end)
-        return self.lhs == other.lhs and (same_position or overlapped_positions)
+        return self.lhs == other.lhs and self.alt == other.alt and self.rhs_begin == other.rhs_begin and \
+            self.rhs_end == other.rhs_end
+
+    def __hash__(self):
+        return hash((self.lhs, self.alt, self.rhs_begin, self.rhs_end))
+
+    def overlaps(self, other):
+        """
+        positions overlap when they are in the same rhs and share at least one symbol. unlike the equality this
+        is not transitive, which is why counting goes by non_overlapping_count rather than by deduping
+        """
+        return self.lhs == other.lhs and self.alt == other.alt and \
+            self.rhs_begin <= other.rhs_end and other.rhs_begin <= self.rhs_end
 
 
 class MatchRecord:
+    """
+    All positions of one match key. the number of matches is the largest number of them that can be replaced at
+    once, i.e. that pairwise don't overlap. positions of different rhss never overlap, and within one rhs, taking
+    the leftmost position and then repeatedly the next one that starts after the last taken one ends gives such a
+    largest set (all positions of a record have the same length). that count is kept per rhs as positions come and
+    go, so get_num_matches is a lookup:
+        site_spans:  (lhs, alt) -> sorted (begin, end) of the positions in that rhs
+        site_counts: (lhs, alt) -> (count, end of the last position taken) of the left to right pass
+    """
 
     mr_count = 0
 
-    def __init__(self, match_sequence, lhs, rhs_begin, rhs_end):
+    def __init__(self, match_sequence, lhs, rhs_begin, rhs_end, alt=None):
         self.match_sequence = match_sequence
-        self.grammar_positions = [GrammarPosition(lhs, rhs_begin, rhs_end)]
+        self.grammar_positions = []
+        self.site_spans = dict()
+        self.site_counts = dict()
+        self.num_matches = 0
         self._count = MatchRecord.mr_count
         MatchRecord.mr_count += 1
+        self.add_new_position(lhs, rhs_begin, rhs_end, alt)
 
     def __str__(self):
         return "count:%d\t%s\t\tpos %s" % \
@@ -163,22 +192,95 @@ class MatchRecord:
                  '; '.join([str(gp) for gp in self.grammar_positions]))
 
     @staticmethod
-    def dedupe_grammar_positions(grammar_positions):
+    def non_overlapping_count(spans):
         """
-        ensure that the grammar positions do not overlap and are the not the same in any other regard
+        :param spans: (begin, end) pairs of one rhs, sorted
+        :return: (count, end of the last span taken)
         """
-        ddp_poss = []
+        count = 0
+        last_end = -1
+        for (b, e) in spans:
+            if b > last_end:
+                count += 1
+                last_end = e
+        return count, last_end
+
+    @staticmethod
+    def dedupe_grammar_positions(grammar_positions, rule_order=None):
+        """
+        :param rule_order: lhs -> index of the rule (see MetaGrammar.rule_order). rules not in it, or all of them if
+                           it isn't given, follow in the order their first position comes in
+        :return: a largest set of the positions that pairwise don't overlap, the same set whatever order they come
+                 in, listed by rule, alternative and position
+        """
+        site_order = dict() if rule_order is None else dict((lhs, (0, i)) for lhs, i in rule_order.items())
         for gp in grammar_positions:
-            if not gp in ddp_poss:
+            site_order.setdefault(gp.lhs, (1, len(site_order)))
+        ddp_poss = []
+        by_site = sorted(grammar_positions, key=lambda gp: (site_order[gp.lhs], -1 if gp.alt is None else gp.alt,
+                                                            gp.rhs_begin, gp.rhs_end))
+        for gp in by_site:
+            if len(ddp_poss) == 0 or not gp.overlaps(ddp_poss[-1]):
                 ddp_poss.append(gp)
         return ddp_poss
 
     def get_num_matches(self):
-        ddp_pos = MatchRecord.dedupe_grammar_positions(self.grammar_positions)
-        return len(ddp_pos)
+        return self.num_matches
 
-    def add_new_position(self, lhs, rhs_begin, rhs_end):
-        self.grammar_positions.append(GrammarPosition(lhs, rhs_begin, rhs_end))
+    def add_new_position(self, lhs, rhs_begin, rhs_end, alt=None, index=None):
+        """
+        :param index: where to insert the position in grammar_positions, the end by default
+        """
+        gp = GrammarPosition(lhs, rhs_begin, rhs_end, alt)
+        if index is None:
+            self.grammar_positions.append(gp)
+        else:
+            self.grammar_positions.insert(index, gp)
+        site = (lhs, alt)
+        spans = self.site_spans.setdefault(site, [])
+        span = (rhs_begin, rhs_end)
+        if len(spans) == 0 or span >= spans[-1]:
+            # the usual case, positions arrive left to right: just continue the pass
+            spans.append(span)
+            (count, last_end) = self.site_counts.get(site, (0, -1))
+            if rhs_begin > last_end:
+                self.site_counts[site] = (count + 1, rhs_end)
+                self.num_matches += 1
+        else:
+            insort(spans, span)
+            self.recount_site(site)
+
+    def recount_site(self, site):
+        (old_count, _) = self.site_counts.pop(site, (0, -1))
+        spans = self.site_spans.get(site, [])
+        if len(spans) == 0:
+            self.site_spans.pop(site, None)
+            self.num_matches -= old_count
+            return
+        (count, last_end) = MatchRecord.non_overlapping_count(spans)
+        self.site_counts[site] = (count, last_end)
+        self.num_matches += count - old_count
+
+    def remove_positions(self, begin, end):
+        """
+        Removes grammar_positions[begin:end], which must all be in the same rhs and be consecutive positions of it
+        (as the slices MetaGrammar.remove_site_matches takes out are), so they are also one slice of its spans
+        """
+        removed = self.grammar_positions[begin:end]
+        del self.grammar_positions[begin:end]
+        if len(removed) == 0:
+            return
+        site = (removed[0].lhs, removed[0].alt)
+        spans = self.site_spans[site]
+        i = bisect_left(spans, (removed[0].rhs_begin, removed[0].rhs_end))
+        j = bisect_right(spans, (removed[-1].rhs_begin, removed[-1].rhs_end))
+        if j - i == len(removed):
+            del spans[i:j]
+        else:
+            # the same span more than once (from patterns with the same match key)
+            for gp in removed:
+                spans.remove((gp.rhs_begin, gp.rhs_end))
+        self.recount_site(site)
 
     @staticmethod
     def get_hash(seq, wildcard_idxs):
@@ -187,6 +289,162 @@ class MatchRecord:
         return '.'.join(['*' if i in wildcard_idxs else str(seq[i]) for i in range(len(seq))])
 
 
+class PatternMatcher:
+    """
+    All pattern strings compiled into one trie, finding in a single pass over a rhs the same matches as running
+    PatternTemplates over it. a template matches a window when the window repeats symbols exactly where the pattern
+    repeats letters and has distinct symbols everywhere else (the wildcard is just one more letter), so both can be
+    written as a signature: for each position, the offset of the first occurrence of the same symbol. from every
+    start the window's signature is extended one symbol at a time and followed down the trie, stopping as soon as
+    no pattern continues it
+    """
+
+    def __init__(self, pattern_strings):
+        self.pattern_strings = list(pattern_strings)
+        self.wildcard_idxs = [[i for i, c in enumerate(ps) if c == PatternTemplate.WILDCARD]
+                              for ps in self.pattern_strings]
+        self.max_len = max([len(ps) for ps in self.pattern_strings], default=0)
+        # node -> {signature entry -> child node}, and the patterns ending at each node
+        self.trie = [dict()]
+        self.accepts = [[]]
+        for p, ps in enumerate(self.pattern_strings):
+            node = 0
+            for k in range(len(ps)):
+                entry = ps.index(ps[k])
+                child = self.trie[node].get(entry)
+                if child is None:
+                    child = len(self.trie)
+                    self.trie[node][entry] = child
+                    self.trie.append(dict())
+                    self.accepts.append([])
+                node = child
+            self.accepts[node].append(p)
+
+    def find(self, seq) -> list:
+        """
+        :return: (pattern index, begin, end) of every match, ordered by end and then by pattern, which is the order
+                 MetaGrammar.consume_sequence reports them in
+        """
+        n = len(seq)
+        trie = self.trie
+        accepts = self.accepts
+        by_end = [None] * n
+        for b in range(n):
+            node = 0
+            first = dict()
+            for k in range(min(self.max_len, n - b)):
+                node = trie[node].get(first.setdefault(seq[b + k], k))
+                if node is None:
+                    break
+                for p in accepts[node]:
+                    if by_end[b + k] is None:
+                        by_end[b + k] = []
+                    by_end[b + k].append((p, b))
+        matches = []
+        for e in range(n):
+            if by_end[e] is not None:
+                matches.extend((p, b, e) for (p, b) in sorted(by_end[e]))
+        return matches
+
+
+class PatternReplacer:
+    """
+    Replaces the occurrences of several match sequences, given in priority order, within each rhs. one left to right
+    scan finds every occurrence of every sequence (a wildcard slot matches any symbol), looking sequences up by the
+    symbol in their first slot so a position only costs the sequences that could begin with it. overlaps are then
+    resolved by priority: the occurrences of the highest priority sequence are accepted left to right, then those of
+    the next one that don't overlap anything accepted so far, and so on
+    """
+
+    def __init__(self, replacements):
+        """
+        :param replacements: list of (match sequence, replacement symbol), highest priority first
+        """
+        self.sequences = [tuple(seq) for (seq, _) in replacements]
+        self.lengths = [len(seq) for seq in self.sequences]
+        self.symbols = [sym for (_, sym) in replacements]
+        # (offset, symbol) of the fixed slots after the first, and the offsets of the wildcard slots
+        self.fixed_slots = [tuple((i, sym) for i, sym in enumerate(seq)
+                                  if i > 0 and sym != PatternTemplate.WILDCARD_SYMBOL)
+                            for seq in self.sequences]
+        self.wildcard_slots = [tuple(i for i, sym in enumerate(seq) if sym == PatternTemplate.WILDCARD_SYMBOL)
+                               for seq in self.sequences]
+        # symbols the wildcard slots covered and number of occurrences replaced, per sequence, added up by rewrite
+        self.wildcard_values = [[] for _ in self.sequences]
+        self.num_replaced = [0] * len(self.sequences)
+        # first symbol -> indexes of the sequences starting with it, plus those starting with a wildcard
+        self.any_first = [p for p, seq in enumerate(self.sequences)
+                          if len(seq) > 0 and seq[0] == PatternTemplate.WILDCARD_SYMBOL]
+        self.by_first = dict()
+        for p, seq in enumerate(self.sequences):
+            if len(seq) > 0 and seq[0] != PatternTemplate.WILDCARD_SYMBOL:
+                self.by_first.setdefault(seq[0], []).append(p)
+        if len(self.any_first) > 0:
+            for sym in self.by_first.keys():
+                self.by_first[sym] = sorted(self.by_first[sym] + self.any_first)
+
+    def find(self, seq) -> list:
+        """
+        :return: (position, sequence index) of the occurrences to replace in seq, by position
+        """
+        n = len(seq)
+        lengths = self.lengths
+        fixed_slots = self.fixed_slots
+        by_first = self.by_first
+        any_first = self.any_first
+        candidates = []
+        for i in range(n):
+            for p in by_first.get(seq[i], any_first):
+                if i + lengths[p] > n:
+                    continue
+                for (offset, sym) in fixed_slots[p]:
+                    if seq[i + offset] != sym:
+                        break
+                else:
+                    candidates.append((p, i))
+        if len(candidates) <= 1:
+            return [(i, p) for (p, i) in candidates]
+        # by priority, then left to right
+        candidates.sort()
+        taken = bytearray(n)
+        accepted = []
+        for (p, i) in candidates:
+            end = i + lengths[p]
+            if taken.find(1, i, end) >= 0:
+                continue
+            accepted.append((i, p))
+            for k in range(i, end):
+                taken[k] = 1
+        accepted.sort()
+        return accepted
+
+    def rewrite(self, seq, occurrences) -> list:
+        """
+        :param occurrences: (position, sequence index) pairs from find, by position
+        :return: seq with those occurrences replaced
+        """
+        new_seq = []
+        i = 0
+        for (b, p) in occurrences:
+            new_seq.extend(seq[i:b])
+            new_seq.append(self.symbols[p])
+            for offset in self.wildcard_slots[p]:
+                self.wildcard_values[p].append(seq[b + offset])
+            self.num_replaced[p] += 1
+            i = b + self.lengths[p]
+        new_seq.extend(seq[i:])
+        return new_seq
+
+    def replace(self, seq):
+        """
+        :return: the rewritten sequence, or None when nothing in seq matched
+        """
+        occurrences = self.find(seq)
+        if len(occurrences) == 0:
+            return None
+        return self.rewrite(seq, occurrences)
+
+
 class MetaGrammar:
 
     def __init__(self, pattern_strings):
@@ -195,6 +453,17 @@ class MetaGrammar:
         self.available_pattern_templates = defaultdict(list)
         self.match_records = dict()
         self.pattern_strings = pattern_strings
+        self.matcher = PatternMatcher(pattern_strings)
+        # occurrence index kept by get_matches, so only rules changed by replace_matches are scanned again:
+        #   rule_order:     lhs -> index of the rule in grammar.rules, which only ever has rules appended
+        #   site_matches:   (lhs, alternative index) -> (the rhs list that was scanned, [(match key, rank)])
+        #   position_ranks: match key -> rank of each of its grammar positions, sorted like the positions
+        # a rank is (rule index, alternative index, end, pattern index), the order a full scan finds matches in
+        self.rule_order = dict()
+        self.site_matches = dict()
+        self.position_ranks = dict()
+        # rules to scan on the next get_matches, None for all of them
+        self.dirty_rules = None
         for ps in pattern_strings:
             # initialize a first pattern template for each of the types of pattern templates
             # more will be created as needed to track patterns as the sequence is traversed
@@ -211,7 +480,7 @@ class MetaGrammar:
 
     def print_match_records(self):
         print("\nMATCH RECORDS --")
-        for k in self.match_records.keys():
+        for k in self.ordered_match_keys():
             if self.match_records[k].get_num_matches() > 1:
                 print(str(self.match_records[k]))
 
@@ -224,16 +493,16 @@ class MetaGrammar:
                 idxs.append(i)
         return idxs
 
-    def add_match_record(self, seq, lhs, curr_pos, wildcard_idxs):
+    def add_match_record(self, seq, lhs, curr_pos, wildcard_idxs, alt=None):
         # we'll only add the match sequence with relevant information here. leave it to another method for
         # how to replace the found sequences (since there will necessarily be conflicts and ordering considerations)
         match_key = MatchRecord.get_hash(seq, wildcard_idxs)
         rhs_begin = curr_pos - len(seq) + 1
         if match_key in self.match_records.keys():
-            self.match_records[match_key].add_new_position(lhs, rhs_begin, curr_pos)
+            self.match_records[match_key].add_new_position(lhs, rhs_begin, curr_pos, alt)
         else:
-            seq_sub = [Symbol(PatternTemplate.WILDCARD, True) if i in wildcard_idxs else seq[i] for i in range(len(seq))]
-            self.match_records[match_key] = MatchRecord(seq_sub, lhs, rhs_begin, curr_pos)
+            seq_sub = [PatternTemplate.WILDCARD_SYMBOL if i in wildcard_idxs else seq[i] for i in range(len(seq))]
+            self.match_records[match_key] = MatchRecord(seq_sub, lhs, rhs_begin, curr_pos, alt)
 
     def ensure_running_pattern_templates_exist(self, pattern_string):
         # either use an existing and available pattern template or create a new one if necessary
@@ -246,7 +515,7 @@ class MetaGrammar:
             patem.set_is_available(False)
             self.running_pattern_templates[pattern_string].append(patem)
 
-    def consume_sequence(self, seq, lhs):
+    def consume_sequence(self, seq, lhs, alt=None):
         for curr_pos in range(len(seq)):
             symbol = seq[curr_pos]
             for ps in self.pattern_strings:
@@ -259,85 +528,169 @@ class MetaGrammar:
                     elif status == Status.FoundMatch:
                         match_sequence = patem.get_match_sequence()
                         wildcard_idxs = self.get_wildcard_idxs(ps)
-                        self.add_match_record(match_sequence, lhs, curr_pos, wildcard_idxs)
+                        self.add_match_record(match_sequence, lhs, curr_pos, wildcard_idxs, alt)
                         if VERBOSE:
                             print("  --- found sequence: '%s' for pattern '%s'" % (' '.join([str(ms) for ms in match_sequence]), ps))
                         self.flag_pattern_template_for_reuse(patem)
-                for patem in self.running_pattern_templates[ps]:
+                for patem in list(self.running_pattern_templates[ps]):
                     if patem.is_available():
                         self.reset_pattern_template_and_make_available(patem, ps)
 
-    @staticmethod
-    def get_wildcard_match_vals(match_sequence, replacement_sequence):
-        wildcard_matches = [replacement_sequence[i] for i in range(len(replacement_sequence))
-                            if match_sequence[i] == Symbol(PatternTemplate.WILDCARD, True)]
-        return wildcard_matches
+    def match_sequence(self, seq, lhs, alt=None):
+        """
+        Adds the same match records as consume_sequence, using the compiled matcher
+        """
+        for (p, b, e) in self.matcher.find(seq):
+            match_sequence = seq[b:e + 1]
+            self.add_match_record(match_sequence, lhs, e, self.matcher.wildcard_idxs[p], alt)
+            if VERBOSE:
+                print("  --- found sequence: '%s' for pattern '%s'" %
+                      (' '.join([str(ms) for ms in match_sequence]), self.pattern_strings[p]))
 
     @staticmethod
-    def replace_all_instances(sequence, subsequence, replacement_symbol: Symbol) -> list:
-        new_sequence = []
-        seq_i = 0
-        wildcard_matches = []
-        while seq_i < len(sequence):
-            if (seq_i + len(subsequence)) > len(sequence):
-                new_sequence.extend(sequence[seq_i:])
-                break
-            matches = [False for _ in range(len(subsequence))]
-            for sub_i in range(0, len(subsequence)):
-                matches[sub_i] = subsequence[sub_i] == sequence[seq_i+sub_i] or \
-                                 subsequence[sub_i] == Symbol(PatternTemplate.WILDCARD, True)
-            if all(matches):
-                if Symbol(PatternTemplate.WILDCARD, True) in subsequence:
-                    match_sequence = sequence[seq_i:seq_i+len(subsequence)]
-                    wildcard_matches.extend(MetaGrammar.get_wildcard_match_vals(subsequence, match_sequence))
-                new_sequence.append(replacement_symbol)
-                seq_i += len(subsequence)
-            else:
-                new_sequence.append(sequence[seq_i])
-                seq_i += 1
-        return new_sequence, wildcard_matches
+    def replace_all_instances(sequence, subsequence, replacement_symbol: Symbol) -> tuple:
+        """
+        Replaces the non-overlapping occurrences of subsequence in sequence, scanning left to right
+        :return: (new sequence, the symbols the wildcard slots covered at each occurrence)
+        """
+        replacer = PatternReplacer([(subsequence, replacement_symbol)])
+        new_sequence = replacer.replace(sequence)
+        if new_sequence is None:
+            new_sequence = list(sequence)
+        return new_sequence, replacer.wildcard_values[0]
+
+    def ordered_match_keys(self) -> list:
+        # the order a full scan would have created the records in
+        if len(self.position_ranks) != len(self.match_records):
+            return list(self.match_records.keys())
+        return sorted(self.match_records.keys(), key=lambda k: self.position_ranks[k][0])
 
     def replace_matches(self):
-        # for now, replace by "first encountered"
-        mr_keys = list(self.match_records.keys())
+        """
+        Replaces the patterns matched at least twice by new rules, in one pass over the grammar. where occurrences
+        of several patterns overlap, the pattern with the most matches wins (see PatternReplacer). a pattern that
+        is left with fewer than 2 occurrences after that is not replaced at all, so every new rule is used at least
+        twice, and only rules with a replacement get a new list of alternatives
+        """
+        mr_keys = self.ordered_match_keys()
         mr_keys_srt = sorted(mr_keys, key=lambda x: self.match_records[x].get_num_matches(), reverse=True)
+        # ensure that we have at least 2 matches to make this a new rule
         mr_keys_fil = list(filter(lambda x: self.match_records[x].get_num_matches() > 1, mr_keys_srt))
-        new_rules = defaultdict(list)
-        for k in mr_keys_fil:
-            # ensure that we have at least 2 matches to make this a new rule
-            if self.match_records[k].get_num_matches() <= 1:
+        new_vals = [PatternTemplate.get_uid() for _ in mr_keys_fil]
+        replacer = PatternReplacer([(self.match_records[k].match_sequence, Symbol(new_val, is_terminal=False))
+                                    for k, new_val in zip(mr_keys_fil, new_vals)])
+        # lhs -> [(alternative index, occurrences)], and the number of occurrences of each pattern
+        found = dict()
+        num_found = [0] * len(mr_keys_fil)
+        for lhs in self.grammar.rules.keys():
+            for a, rhs in enumerate(self.grammar.rules[lhs]):
+                occurrences = replacer.find(rhs)
+                if len(occurrences) > 0:
+                    found.setdefault(lhs, []).append((a, occurrences))
+                    for (_, p) in occurrences:
+                        num_found[p] += 1
+        for lhs, alt_occurrences in found.items():
+            rhss = self.grammar.rules[lhs]
+            new_rhss = None
+            for (a, occurrences) in alt_occurrences:
+                occurrences = [(b, p) for (b, p) in occurrences if num_found[p] > 1]
+                if len(occurrences) == 0:
+                    continue
+                # unchanged alternatives keep their list, which tells get_matches they need no rescan
+                if new_rhss is None:
+                    new_rhss = list(rhss)
+                new_rhss[a] = replacer.rewrite(rhss[a], occurrences)
+            if new_rhss is not None:
+                self.grammar.rules[lhs] = new_rhss
+                self.mark_dirty(lhs)
+        for p, k in enumerate(mr_keys_fil):
+            if replacer.num_replaced[p] == 0:
                 continue
-            new_val = PatternTemplate.get_uid()
-            newval_sym = Symbol(new_val, is_terminal=False)
-            match_record = self.match_records[k]
-            for lhs in self.grammar.rules.keys():
-                for rhs in self.grammar.rules[lhs]:
-                    new_rhs, wildcard_matches = MetaGrammar.replace_all_instances(rhs, match_record.match_sequence, newval_sym)
-                    found_match = len(new_rhs) != len(rhs) or any([new_rhs[i] != rhs[i] for i in range(len(rhs))])
-                    self.grammar.rules[lhs] = [new_rhs if r == rhs else r for r in self.grammar.rules[lhs]]
-                    if len(wildcard_matches) > 0:
-                        new_wildcard_rule_lhs = PatternTemplate.get_uid()
-                        new_rules[new_wildcard_rule_lhs] = [[w] for w in wildcard_matches]
-                        new_rules[new_val] = [[sym if sym != Symbol(PatternTemplate.WILDCARD, True) else Symbol(new_wildcard_rule_lhs, False)
-                                               for sym in match_record.match_sequence[:]]]
-                    elif found_match:
-                        new_rules[new_val] = [[sym for sym in match_record.match_sequence[:]]]
-        for new_rule_lhs in new_rules.keys():
-            self.grammar.rules[new_rule_lhs] = new_rules[new_rule_lhs]
-        foo = 1
+            match_sequence = self.match_records[k].match_sequence
+            if len(replacer.wildcard_values[p]) > 0:
+                # one rule holding each distinct symbol the wildcard stood for, in order of first occurrence, weighted
+                # by how many matches it stood for
+                counts = Counter(replacer.wildcard_values[p])
+                new_wildcard_rule_lhs = PatternTemplate.get_uid()
+                self.grammar.rules[new_wildcard_rule_lhs] = [[w] for w in counts.keys()]
+                self.grammar.set_weights(new_wildcard_rule_lhs, list(counts.values()))
+                self.mark_dirty(new_wildcard_rule_lhs)
+                new_rule = [sym if sym != PatternTemplate.WILDCARD_SYMBOL else Symbol(new_wildcard_rule_lhs, False)
+                            for sym in match_sequence]
+            else:
+                new_rule = list(match_sequence)
+            self.grammar.rules[new_vals[p]] = [new_rule]
+            self.mark_dirty(new_vals[p])
 
     def reset_matches(self):
         self.match_records = dict()
+        self.site_matches = dict()
+        self.position_ranks = dict()
+        self.dirty_rules = None
+
+    def mark_dirty(self, lhs):
+        if self.dirty_rules is not None:
+            self.dirty_rules.add(lhs)
 
     def get_matches(self):
+        """
+        Brings the match records up to date with the grammar. the first call scans every rhs; after that only the
+        alternatives of rules replace_matches changed are scanned again, their old positions taken out of the
+        records and the new ones put in at their rank, so the records are the same as from a full scan
+        """
         for rule_lhs in self.grammar.rules.keys():
+            rule_idx = self.rule_order.setdefault(rule_lhs, len(self.rule_order))
+            if self.dirty_rules is not None and rule_lhs not in self.dirty_rules:
+                continue
             if VERBOSE:
                 print("LHS: %s" % rule_lhs)
-            for rhs in self.grammar.rules[rule_lhs]:
+            for alt, rhs in enumerate(self.grammar.rules[rule_lhs]):
+                scanned = self.site_matches.get((rule_lhs, alt))
+                if scanned is not None:
+                    if scanned[0] is rhs:
+                        continue
+                    self.remove_site_matches(rule_lhs, alt)
                 if VERBOSE:
                     print("RHS: %s" % [sym.val for sym in rhs])
-                self.consume_sequence(rhs, rule_lhs)
-                self.reset_all_pattern_templates()
+                self.add_site_matches(rule_lhs, rule_idx, alt, rhs)
+        self.dirty_rules = set()
+
+    def add_site_matches(self, lhs, rule_idx, alt, rhs):
+        entries = []
+        for (p, b, e) in self.matcher.find(rhs):
+            match_sequence = rhs[b:e + 1]
+            wildcard_idxs = self.matcher.wildcard_idxs[p]
+            match_key = MatchRecord.get_hash(match_sequence, wildcard_idxs)
+            rank = (rule_idx, alt, e, p)
+            ranks = self.position_ranks.get(match_key)
+            if ranks is None:
+                seq_sub = [PatternTemplate.WILDCARD_SYMBOL if i in wildcard_idxs else match_sequence[i]
+                           for i in range(len(match_sequence))]
+                self.match_records[match_key] = MatchRecord(seq_sub, lhs, b, e, alt)
+                self.position_ranks[match_key] = [rank]
+            else:
+                i = bisect_right(ranks, rank)
+                ranks.insert(i, rank)
+                self.match_records[match_key].add_new_position(lhs, b, e, alt, index=i)
+            entries.append((match_key, rank))
+            if VERBOSE:
+                print("  --- found sequence: '%s' for pattern '%s'" %
+                      (' '.join([str(ms) for ms in match_sequence]), self.pattern_strings[p]))
+        self.site_matches[(lhs, alt)] = (rhs, entries)
+
+    def remove_site_matches(self, lhs, alt):
+        (_, entries) = self.site_matches.pop((lhs, alt))
+        rule_idx = self.rule_order[lhs]
+        # ranks start with (rule index, alternative index), so each record has the site's positions in one slice
+        for match_key in set(match_key for (match_key, _) in entries):
+            ranks = self.position_ranks[match_key]
+            i = bisect_left(ranks, (rule_idx, alt))
+            j = bisect_left(ranks, (rule_idx, alt + 1))
+            del ranks[i:j]
+            self.match_records[match_key].remove_positions(i, j)
+            if len(ranks) == 0:
+                del self.position_ranks[match_key]
+                del self.match_records[match_key]
 
     def matches_found(self):
         filtered_list = list(filter(lambda x: self.match_records[x].get_num_matches() > 1, list(self.match_records.keys())))
@@ -354,28 +707,31 @@ class MetaGrammar:
 
     def reset_all_pattern_templates(self):
         for ps_key in self.running_pattern_templates.keys():
-            for patem in self.running_pattern_templates[ps_key]:
+            for patem in list(self.running_pattern_templates[ps_key]):
                 self.reset_pattern_template_and_make_available(patem, ps_key)
 
     def report(self, out_fh):
-        self.print_to_file(out_fh)
+        if out_fh is not None:
+            self.print_to_file(out_fh)
         self.print_match_records()
         self.print_grammar()
 
-    def run(self):
-        fh = open("metagrammar_run.txt", 'w')
-        self.report(fh)
-        #self.print_to_file(fh)
-        self.get_matches()
-        while self.matches_found():
-            #self.print_match_records()
-            self.replace_matches()
-            #self.print_to_file(fh)
-            #self.print_grammar()
-            self.reset_matches()
-            self.get_matches()
+    def run(self, report_filename=None):
+        """
+        Replaces matches until there are none left
+        :param report_filename: if given, the grammar is also written to this file after every iteration
+        """
+        fh = None if report_filename is None else open(report_filename, 'w')
+        try:
             self.report(fh)
-        fh.close()
+            self.get_matches()
+            while self.matches_found():
+                self.replace_matches()
+                self.get_matches()
+                self.report(fh)
+        finally:
+            if fh is not None:
+                fh.close()
 
     def print_grammar(self):
         print("\nGRAMMAR --\n%s" % str(self.grammar))
@@ -388,6 +744,14 @@ class MetaGrammar:
         fh.write(json.dumps(self.grammar.to_serializable(), indent=4, sort_keys=True))
         fh.close()
 
+    def weight_alternatives(self):
+        # wildcard rules already carry their match counts as weights. this merges repeated alternatives, such as a
+        # sentence that occurs twice, into one whose weight is their count
+        self.grammar.collapse_duplicates()
+
+    def save_grammar_binary(self, filename="metag.bin"):
+        self.grammar.save_binary(filename)
+
 
 def simple_text():
     return 'john hit the pedestrian. mary hit a tree!'
@@ -432,9 +796,10 @@ def runner(text):
     print("\n--- INITIAL")
     mg.print_grammar()
     print("\n--- PATTERNS...")
-    mg.run()
+    mg.run('metagrammar_run.txt')
     print("\n--- FINAL")
     mg.print_grammar()
+    mg.weight_alternatives()
     print("\n--- RANDOM SENTENCES")
     NUM_SENTS = 20
     gen_trees = []
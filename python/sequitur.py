@@ -1,14 +1,15 @@
-import string
+from collections import defaultdict, deque
 import cfg
 
 
 # NOTES:
-# the only thing missing from this is the elimination of rules that only appear once. the rest works well
-# (and it was a pain to get it to work!). it warrants more work, should time become available (Nov, 2016)
+# rules that end up being used only once are inlined as soon as their use count drops to one (rule utility).
+# the rest works well (and it was a pain to get it to work!)
 
 class Node:
 
-    id = 0
+    # nodes make up almost all of the memory held by a grammar, so keep them free of a per-instance __dict__
+    __slots__ = ('_data', '_next', '_prev', '_is_terminal', '_rule_ptr', '_tail')
 
     def __init__(self, data, prevnode=None, nextnode=None, is_terminal=False):
         self._data = data
@@ -16,21 +17,15 @@ class Node:
         self._prev = prevnode
         self._is_terminal = is_terminal
         self._rule_ptr = None
-        self._nodeid = Node.get_unique_nodeid()
+        # only maintained on rule head nodes: the last node of the rule's rhs
+        self._tail = None
 
     def __str__(self):
-        return "[%s_%d]" % (str(self._data), self._nodeid)
-
-    #def __eq__(self, other):
-    #    return other.get_uuid() == self._uuid
-
-    @staticmethod
-    def get_unique_nodeid():
-        Node.id += 1
-        return Node.id
+        return "[%s_%d]" % (str(self._data), self.get_nodeid())
 
     def get_nodeid(self):
-        return self._nodeid
+        # unique for as long as the node is alive, which is all that is needed to tell nodes apart
+        return id(self)
 
     @staticmethod
     def get_symlink(node):
@@ -50,6 +45,12 @@ class Node:
     def get_prev(self):
         return self._prev
 
+    def get_tail(self):
+        return self._tail
+
+    def set_tail(self, node):
+        self._tail = node
+
     def get_data(self):
         return self._data
 
@@ -65,6 +66,8 @@ class Node:
 
 class Digram:
 
+    __slots__ = ('le', 'ri')
+
     def __init__(self, left, right):
         self.le = left
         self.ri = right
@@ -76,37 +79,124 @@ class Digram:
         return Sequitur.is_guard_node(self.le) or Sequitur.is_guard_node(self.ri)
 
 
-class Sequitur:
+class SymbolTable:
+    """
+    Maps symbol values to small integers so that nodes and digram keys only ever hold ints. values are decoded
+    back when the grammar is printed or serialized
+    """
 
-    GUARD_SYMBOL = '[]'
-    START_SYMBOL = 'S'
+    def __init__(self):
+        self.ids = dict()
+        self.values = []
 
-    str_idx = -1
-    num_chars = 1
+    def __len__(self):
+        return len(self.values)
 
-    @staticmethod
-    def get_uid():
-        if Sequitur.str_idx >= len(string.ascii_uppercase):
-            Sequitur.str_idx = 0
-            Sequitur.num_chars += 1
-        uid = string.ascii_uppercase[Sequitur.str_idx + 1]
-        Sequitur.str_idx += 1
-        return uid
+    def intern(self, val) -> int:
+        sym_id = self.ids.get(val)
+        if sym_id is None:
+            sym_id = self.new_id(val)
+            self.ids[val] = sym_id
+        return sym_id
 
-    def __init__(self):
+    def new_id(self, val) -> int:
+        """
+        Allocates an id that is never handed out by intern, so rule names can't be confused with terminals
+        """
+        self.values.append(val)
+        return len(self.values) - 1
+
+    def decode(self, sym_id):
+        return self.values[sym_id]
+
+
+class Event:
+
+    SymbolConsumed = "symbol_consumed"
+    RuleCreated = "rule_created"
+    RuleReused = "rule_reused"
+    RuleInlined = "rule_inlined"
+    DigramIndexed = "digram_indexed"
+
+
+class Sequitur:
+
+    GUARD_SYMBOL = '[]'
+    START_SYMBOL = 'S'
+    # ids reserved in every symbol table, see __init__
+    GUARD_ID = 0
+    START_ID = 1
+    # digram keys pack both symbol ids into one int
+    DIGRAM_KEY_SHIFT = 32
+
+    RULE_PREFIX = 'R'
+
+    def __init__(self, verbose=False, rule_utility=True):
+        self.symbols = SymbolTable()
+        self.symbols.new_id(Sequitur.GUARD_SYMBOL)
+        self.symbols.new_id(Sequitur.START_SYMBOL)
         self.digram_index = dict()
         # start off rule structure with the start rule
         self.start_rule = Sequitur.construct_start_rule()
         self.rule_counts = dict()
+        self.num_rules = 0
+        # verbose dumps the whole grammar after every symbol, which is only useful for debugging small inputs
+        self.verbose = verbose
+        # rule_utility=False keeps rules that are only used once, which is only really useful for comparisons
+        self.rule_utility = rule_utility
+        self.hooks = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def new_rule_id(self) -> int:
+        """
+        Allocates the symbol id of a new rule. rules are numbered per instance in order of creation and the number
+        only becomes a name when the grammar is printed or serialized
+        """
+        self.num_rules += 1
+        return self.symbols.new_id(self.num_rules)
+
+    def get_rule_name(self, rule_id: int) -> str:
+        if rule_id == Sequitur.START_ID:
+            return Sequitur.START_SYMBOL
+        return "%s%d" % (Sequitur.RULE_PREFIX, self.symbols.decode(rule_id))
+
+    def get_node_name(self, node: Node):
+        if node.is_terminal():
+            return self.symbols.decode(node.get_data())
+        return self.get_rule_name(node.get_data())
+
+    def add_hook(self, event, fn):
+        """
+        Registers a callback for one of the Event types. callbacks only run when the event happens
+        :param event: Event type
+        :param fn: called with the rule head node (rule events), the digram (DigramIndexed) or the value consumed
+        """
+        self.hooks[event].append(fn)
+
+    def fire(self, event, obj):
+        self.counters[event] += 1
+        if event in self.hooks:
+            for fn in self.hooks[event]:
+                fn(obj)
+
+    def get_counters(self) -> dict:
+        return dict(self.counters)
 
     @staticmethod
     def construct_start_rule():
-        rule_node = Node(Sequitur.START_SYMBOL, is_terminal=False)
+        rule_node = Node(Sequitur.START_ID, is_terminal=False)
         guard_node = Sequitur.create_guard_node(rule_node)
         rule_node.set_next(guard_node)
         guard_node.set_prev(rule_node)
         return rule_node
 
+    def grammar_size(self) -> tuple:
+        """
+        :return: number of rules (including the start rule) and total number of rhs symbols
+        """
+        rules = Sequitur.get_rules(self.start_rule)
+        return len(rules), sum([len(self.get_rule_rhs_object_list(r)) for r in rules])
+
     def __str__(self):
         index_table = "{%s}" % " ".join(["%s" % str(s) for s in self.digram_index])
         start_rule = "%s" % self.get_start_rule_string()
@@ -116,7 +206,7 @@ class Sequitur:
         s = Sequitur.START_SYMBOL + "->"
         n = self.start_rule.get_next().get_next()
         while not Sequitur.is_guard_node(n):
-            s += "%s " % n.get_data()
+            s += "%s " % self.get_node_name(n)
             n = n.get_next()
         return s
 
@@ -128,20 +218,19 @@ class Sequitur:
 
     def print_grammar_string(self):
         rules = Sequitur.get_rules(self.start_rule)
-        s = '\n'.join([Sequitur.rule_string(r) for r in rules])
+        s = '\n'.join([self.rule_string(r) for r in rules])
         print("----GRAMMAR----\n%s\n---------------\n" % s)
 
     def p(self):
         self.print_grammar_string()
 
-    @staticmethod
-    def rule_string(rule_head_node: Node) -> str:
-        s = rule_head_node.get_data()
+    def rule_string(self, rule_head_node: Node) -> str:
+        s = self.get_rule_name(rule_head_node.get_data())
         s += " -> "
         # skip guard node
         next_node = Sequitur.get_rule_rhs(rule_head_node)
         while not Sequitur.is_guard_node(next_node):
-            s += "%s " % next_node.get_data()
+            s += "%s " % self.get_node_name(next_node)
             next_node = next_node.get_next()
         return s
 
@@ -154,35 +243,42 @@ class Sequitur:
 
     @staticmethod
     def get_rules(start_rule_node):
-        rules_todo_list = [start_rule_node]
+        """
+        Collects every rule reachable from the start rule, breadth first, so the start rule comes first and the
+        rest follow in order of first use
+        :param start_rule_node: head node of the start rule
+        :return: list of rule head nodes
+        """
+        rules_todo = deque([start_rule_node])
+        rules_seen = {start_rule_node.get_data()}
         rules_done_list = []
-        while len(rules_todo_list) > 0:
-            rule = rules_todo_list[0]
+        while len(rules_todo) > 0:
+            rule = rules_todo.popleft()
             rules_done_list.append(rule)
             node = Sequitur.get_rule_rhs(rule)
             if node is None:
                 continue
             while not Sequitur.is_guard_node(node):
                 rule_ptr = node.get_rule_ptr()
-                if rule_ptr is not None and rule_ptr.get_data() not in [n.get_data() for n in rules_todo_list]:
-                    rules_todo_list.append(node.get_rule_ptr())
+                if rule_ptr is not None and rule_ptr.get_data() not in rules_seen:
+                    rules_seen.add(rule_ptr.get_data())
+                    rules_todo.append(rule_ptr)
                 node = node.get_next()
-            rules_todo_list = rules_todo_list[1:]
-        return list(set(rules_done_list))
+        return rules_done_list
 
     @staticmethod
     def dedupe_rule_list(rules):
-        seen = []
+        seen = set()
         lst = []
         for obj in rules:
             if obj.get_data() not in seen:
                 lst.append(obj)
-                seen.append(obj.get_data())
+                seen.add(obj.get_data())
         return lst
 
     @staticmethod
-    def get_digram_key(digram: Digram) -> string:
-        return '.'.join([digram.le.get_data(), digram.ri.get_data()])
+    def get_digram_key(digram: Digram) -> int:
+        return (digram.le.get_data() << Sequitur.DIGRAM_KEY_SHIFT) | digram.ri.get_data()
 
     def add_digram_to_index(self, digram: Digram):
         if digram.contains_guard_node():
@@ -190,13 +286,14 @@ class Sequitur:
         digram_key = self.get_digram_key(digram)
         ref_node = digram.le
         self.digram_index[digram_key] = ref_node
+        self.fire(Event.DigramIndexed, digram)
 
     @staticmethod
     def create_guard_node(rule_node: Node) -> Node:
-        return Node(Sequitur.GUARD_SYMBOL, prevnode=rule_node, is_terminal=False)
+        return Node(Sequitur.GUARD_ID, prevnode=rule_node, is_terminal=False)
 
     def construct_rule_head(self) -> Node:
-        rule_id = Sequitur.get_uid()
+        rule_id = self.new_rule_id()
         rule_node = Node(rule_id, is_terminal=False)
         guard_node = self.create_guard_node(rule_node)
         rule_node.set_next(guard_node)
@@ -205,7 +302,7 @@ class Sequitur:
 
     @staticmethod
     def is_guard_node(node: Node) -> bool:
-        return node.get_data() == Sequitur.GUARD_SYMBOL
+        return node.get_data() == Sequitur.GUARD_ID
 
     @staticmethod
     def get_rule_end_node(rule_start_node: Node) -> Node:
@@ -237,8 +334,7 @@ class Sequitur:
             curr = curr.get_next()
         return vals
 
-    @staticmethod
-    def get_rule_rhs_object_list(rule_node: Node) -> list:
+    def get_rule_rhs_object_list(self, rule_node: Node) -> list:
         """
         Returns a list of objects whose fields contain the RHS element data and whether it is a terminal
         :param rule_node:
@@ -247,7 +343,7 @@ class Sequitur:
         curr = Sequitur.get_rule_rhs(rule_node)
         vals = []
         while not Sequitur.is_guard_node(curr):
-            vals.append(cfg.Symbol(val=curr.get_data(), is_terminal=curr.is_terminal))
+            vals.append(cfg.Symbol(val=self.get_node_name(curr), is_terminal=curr.is_terminal()))
             curr = curr.get_next()
         return vals
 
@@ -258,12 +354,30 @@ class Sequitur:
         else:
             return False
 
+    def get_indexed_rule(self, index_node: Node):
+        """
+        Finds the rule whose whole rhs is the indexed digram, if there is one. rules made from a single digram are
+        indexed by their head node, but a rule can also come to be two symbols long after inlining or replacements
+        within it, in which case the index points at the first node of its rhs
+        :param index_node: node stored in the digram index
+        :return: rule head node or None
+        """
+        if Sequitur.index_node_is_rule(index_node):
+            return index_node
+        prev_node = index_node.get_prev()
+        if prev_node is None or not Sequitur.is_guard_node(prev_node):
+            return None
+        if not Sequitur.is_guard_node(index_node.get_next().get_next()):
+            return None
+        rule_node = prev_node.get_prev()
+        return None if rule_node is self.start_rule else rule_node
+
     @staticmethod
     def rule_exists_for_digram(rule_ref_node: Node, digram: Digram) -> bool:
         digram_ref_node = digram.le
         # in order for a rule to match a digram, the rule must start with the first element, end with the last and
         # have nothing in between. also make sure it is a rule
-        if rule_ref_node.get_data() == Sequitur.START_SYMBOL:
+        if rule_ref_node.get_data() == Sequitur.START_ID:
             # don't want to match start rule
             return False
         digram_data = [digram_ref_node.get_data(), digram_ref_node.get_next().get_data()]
@@ -273,23 +387,27 @@ class Sequitur:
         return all([digram_data[i] == rule_data[i] for i in range(len(digram_data))])
 
     def digram_exists(self, digram: Digram) -> bool:
-        return self.get_digram_key(digram) in self.digram_index.keys()
+        return self.get_digram_key(digram) in self.digram_index
 
     def start_rule_empty(self) -> bool:
-        return self.start_rule.get_next().get_next() is None
+        return self.start_rule.get_tail() is None
+
+    @staticmethod
+    def update_rule_tail(guard_node: Node, tail_node: Node):
+        # the guard node keeps the rule head as its previous node, so the head is always one hop away
+        guard_node.get_prev().set_tail(tail_node)
 
     def append_to_start_rule(self, new_node: Node):
+        guard_node = self.start_rule.get_next()
         if self.start_rule_empty():
-            guard_node = self.start_rule.get_next()
             guard_node.set_next(new_node)
             new_node.set_prev(guard_node)
-            new_node.set_next(guard_node)
         else:
-            end_node = Sequitur.get_rule_end_node(self.start_rule)
-            guard_node = end_node.get_next()
+            end_node = self.start_rule.get_tail()
             end_node.set_next(new_node)
             new_node.set_prev(end_node)
-            new_node.set_next(guard_node)
+        new_node.set_next(guard_node)
+        self.start_rule.set_tail(new_node)
 
     def create_new_rule(self, index_node: Node, digram: Digram) -> Node:
         index_digram = Digram(index_node, index_node.get_next())
@@ -303,11 +421,10 @@ class Sequitur:
         prev_node = digram.le.get_prev()
         next_node = digram.ri.get_next()
         rule_symlink = self.splice_rule_into_digram_position(rule_node, digram, prev_node, next_node)
+        self.fire(Event.RuleCreated, rule_node)
+        self.enforce_rule_utility(rule_node)
         return rule_symlink
 
-    def digram_is_repeated_nonterminals(self, digram):
-        return digram.ri.get_data() == digram.le.get_data() and not digram.le.is_terminal()
-
     def splice_new_rule_into_index_digram_position(self, new_rule: Node, index_digram: Digram, prev_node: Node, next_node: Node):
         rule_symlink = Node.get_symlink(new_rule)
         self.make_link_shallow(prev_node, rule_symlink)
@@ -316,25 +433,72 @@ class Sequitur:
         self.remove_from_index(Digram(index_digram.ri, next_node))
         self.update_index(index_digram, new_rule)
         self.increment_rule_counts(rule_symlink.get_data())
-        if self.digram_is_repeated_nonterminals(index_digram):
-            self.decrement_rule_counts(index_digram.le.get_data())
 
     def splice_rule_into_digram_position(self, rule: Node, digram: Digram, prev_node: Node, next_node: Node):
+        # the digram's own nodes are dropped in favour of the symlink, so any rules they referred to lose a use
+        self.release_node(digram.le)
+        self.release_node(digram.ri)
         rule_symlink = Node.get_symlink(rule)
+        self.increment_rule_counts(rule_symlink.get_data())
         # make 'next link' first so that rule symlink 'knows' where it is going. this turns out to be important
         self.make_link(rule_symlink, next_node)
         self.remove_from_index(Digram(digram.ri, next_node))
         # keep track of rule_symlink updates due to new links made recursively
         rule_symlink = self.make_link(prev_node, rule_symlink)
         self.remove_from_index(Digram(prev_node, digram.le))
-        self.increment_rule_counts(rule_symlink.get_data())
-        if self.digram_is_repeated_nonterminals(digram):
-            self.decrement_rule_counts(digram.le.get_data())
         return rule_symlink
 
+    def release_node(self, node: Node):
+        if node.get_rule_ptr() is not None:
+            self.decrement_rule_counts(node.get_data())
+
+    def enforce_rule_utility(self, rule_node: Node):
+        """
+        Inlines any rule referenced from the rhs of rule_node that is now only used once. a rule loses uses when a
+        digram containing it is replaced, and the digram's first occurrence is what forms the rhs of rule_node, so
+        the remaining use of such a rule is always found here
+        :param rule_node: head node of the rule just created or reused
+        """
+        if not self.rule_utility or rule_node.get_data() not in self.rule_counts:
+            # disabled, or already inlined by a nested replacement
+            return
+        node = Sequitur.get_rule_rhs(rule_node)
+        while not Sequitur.is_guard_node(node):
+            rule_ptr = node.get_rule_ptr()
+            if rule_ptr is not None and self.rule_counts[rule_ptr.get_data()] == 1:
+                # carry on from the start of the inlined rhs so that anything it now exposes is checked as well
+                node = self.inline_rule(node)
+            else:
+                node = node.get_next()
+
+    def inline_rule(self, rule_symlink: Node) -> Node:
+        """
+        Replaces the only remaining use of a rule with the rule's rhs and deletes the rule
+        :param rule_symlink: the symlink node of the rule to inline
+        :return: first node of the inlined rhs
+        """
+        rule_node = rule_symlink.get_rule_ptr()
+        first_node = Sequitur.get_rule_rhs(rule_node)
+        last_node = rule_node.get_tail()
+        prev_node = rule_symlink.get_prev()
+        next_node = rule_symlink.get_next()
+        self.remove_from_index(Digram(prev_node, rule_symlink))
+        self.remove_from_index(Digram(rule_symlink, next_node))
+        # a rule made from a single digram is indexed by its head node, which is about to go away
+        body_key = self.get_digram_key(Digram(first_node, first_node.get_next()))
+        if self.digram_index.get(body_key) is rule_node:
+            self.digram_index[body_key] = first_node
+        self.make_link_shallow(prev_node, first_node)
+        self.make_link_shallow(last_node, next_node)
+        del self.rule_counts[rule_node.get_data()]
+        self.fire(Event.RuleInlined, rule_node)
+        return first_node
+
     def add_digram_to_rule(self, guard: Node, digram: Digram):
         guard.set_next(digram.le)
+        digram.le.set_prev(guard)
         digram.ri.set_next(guard)
+        Sequitur.update_rule_tail(guard, digram.ri)
 
     def make_link_shallow(self, left_node: Node, right_node: Node):
         left_node.set_next(right_node)
@@ -343,6 +507,8 @@ class Sequitur:
         # a guard node should maintain the rule head node as its previous node
         if not Sequitur.is_guard_node(right_node):
             right_node.set_prev(left_node)
+        else:
+            Sequitur.update_rule_tail(right_node, left_node)
         if not already_in_index:
             self.add_digram_to_index(digram)
 
@@ -353,10 +519,11 @@ class Sequitur:
         self.make_link_shallow(left_node, right_node)
         if digram_index_already_exists:
             index_node = self.digram_index[self.get_digram_key(Digram(left_node, right_node))]
-            if index_node.get_next().get_nodeid() == left_node.get_nodeid():
+            if index_node.get_next() is left_node:
                 # enforce constraint that a new rule cannot be built twice in succession
                 return return_node
-            if not Sequitur.index_node_is_rule(index_node):
+            rule_node = self.get_indexed_rule(index_node)
+            if rule_node is None:
                 # the index node points to a previous location in the start rule and not to a digram rule,
                 # so create one. and in so doing, replace the previous instance with it
                 rule_node_symlink = self.create_new_rule(index_node, Digram(left_node, right_node))
@@ -364,10 +531,12 @@ class Sequitur:
                 digram = Digram(left_node, right_node)
                 next_node = right_node.get_next()
                 prev_node = left_node.get_prev()
-                rule_node_symlink = self.splice_rule_into_digram_position(rule=index_node,
+                rule_node_symlink = self.splice_rule_into_digram_position(rule=rule_node,
                                                                           digram=digram,
                                                                           prev_node=prev_node,
                                                                           next_node=next_node)
+                self.fire(Event.RuleReused, rule_node)
+                self.enforce_rule_utility(rule_node)
             # we've changed what is the 'current node' because we've replaced it with a rule symlink
             return_node = rule_node_symlink
         return return_node
@@ -375,20 +544,46 @@ class Sequitur:
     def print_rule_counts(self):
         print("rule counts:")
         for k in self.rule_counts.keys():
-            print("%s) %d" % (k, self.rule_counts[k]))
+            print("%s) %d" % (self.get_rule_name(k), self.rule_counts[k]))
         print("\n")
 
-    def consume_sequence(self, seq_vals: list):
-        left_node = Node(seq_vals[0], is_terminal=True)
-        self.append_to_start_rule(left_node)
-        for i in range(1, len(seq_vals)):
-            right_node = Node(seq_vals[i], is_terminal=True)
-            self.append_to_start_rule(right_node)
-            print("%s | %s\n" % (' '.join(seq_vals[:(i+1)]), ' '.join(seq_vals[(i+1):])))
-            left_node = self.make_link(left_node=left_node, right_node=right_node)
+    def feed(self, val):
+        """
+        Extends the grammar by a single terminal symbol
+        :param val: symbol value
+        """
+        # the tail of the start rule is the 'current node', i.e. whatever the previous symbol ended up as
+        left_node = self.start_rule.get_tail()
+        right_node = Node(self.symbols.intern(val), is_terminal=True)
+        self.append_to_start_rule(right_node)
+        self.fire(Event.SymbolConsumed, val)
+        if left_node is None:
+            return
+        if self.verbose:
+            print("%s | %s\n" % (self.get_start_rule_string(), val))
+        self.make_link(left_node=left_node, right_node=right_node)
+        if self.verbose:
             self.print_grammar_string()
             self.print_rule_counts()
-            #left_node = right_node
+
+    def feed_many(self, vals):
+        """
+        Extends the grammar with every symbol of an iterable, which is consumed lazily (e.g. a generator over a file)
+        :param vals: iterable of symbol values
+        """
+        for val in vals:
+            self.feed(val)
+
+    def consume_sequence(self, seq_vals: list):
+        self.feed_many(seq_vals)
+
+    def snapshot(self) -> dict:
+        """
+        Copies out the grammar induced so far. the copy does not share any state with this object, so feeding can
+        carry on afterwards
+        :return: dict of rule lists in the same form as to_serializable
+        """
+        return Sequitur.to_serializable(self)
 
     @staticmethod
     def generate_random_sentence_helper():
@@ -408,13 +603,14 @@ class Sequitur:
         for rule in rules:
             # in the future, we might need multiple rules for each non-terminal, so making the following a list of lists
             # (also allows it to work with cfg module concept of a grammar)
-            rules_dict[rule.get_data()] = [Sequitur.get_rule_rhs_object_list(rule)]
+            rules_dict[sequitur.get_rule_name(rule.get_data())] = [sequitur.get_rule_rhs_object_list(rule)]
         return rules_dict
 
     @staticmethod
-    def run(seq: list):
-        s = Sequitur()
+    def run(seq: list, verbose=False):
+        s = Sequitur(verbose=verbose)
         s.consume_sequence(seq)
+        return s
 
 
 if __name__ == '__main__':
@@ -423,7 +619,7 @@ if __name__ == '__main__':
     #seq = 'Most labour sentiment would still favor the abolition of the House of Lords'.split(' ')
     #seq = list('in the beginning god created the heaven and the earth')
     #Sequitur.run(seq)
-    sequitur = Sequitur()
+    sequitur = Sequitur(verbose=True)
     sequitur.consume_sequence(seq)
     #Sequitur.to_serializable(sequitur)
     #sent = Sequitur.generate_random_sentence(sequitur)
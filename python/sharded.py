@@ -0,0 +1,118 @@
+import os
+import sys
+from multiprocessing import Pool
+from cfg import CFG, Symbol
+from sequitur import Sequitur
+
+
+def induce_document(doc: list) -> dict:
+    """
+    Runs Sequitur over a single document
+    :param doc: list of terminal symbol values
+    :return: dict of rule name -> rhs, with the rhs as a list of (value, is_terminal) tuples
+    """
+    s = Sequitur()
+    s.feed_many(doc)
+    if s.start_rule_empty():
+        return {Sequitur.START_SYMBOL: []}
+    rules = Sequitur.to_serializable(s)
+    return dict((lhs, [(sym.val, sym.is_terminal) for sym in rhss[0]]) for lhs, rhss in rules.items())
+
+
+def induce_shard(docs: list) -> list:
+    return [induce_document(doc) for doc in docs]
+
+
+def shard_corpus(docs: list, num_shards: int) -> list:
+    shard_size = max(1, -(-len(docs) // num_shards))
+    return [docs[i:i + shard_size] for i in range(0, len(docs), shard_size)]
+
+
+class GrammarMerger:
+    """
+    Merges Sequitur grammars into a single CFG. rules are renumbered and any two rules, from the same grammar or
+    from different ones, that expand to the same rhs become a single rule. the start rule of each grammar becomes
+    one alternative of the merged start rule
+    """
+
+    RULE_PREFIX = 'R'
+
+    def __init__(self):
+        # rhs (as a tuple of (value, is_terminal)) -> merged rule name
+        self.rule_ids = dict()
+        self.rules = []
+        self.start_alternatives = []
+
+    def merge_rule(self, grammar: dict, lhs: str, renamed: dict) -> str:
+        # sequitur grammars are acyclic, so an explicit stack of rules still to finish is enough
+        stack = [lhs]
+        while len(stack) > 0:
+            name = stack[-1]
+            pending = [val for (val, is_terminal) in grammar[name] if not is_terminal and val not in renamed]
+            if len(pending) > 0:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            if name in renamed:
+                continue
+            rhs = tuple((val, True) if is_terminal else (renamed[val], False) for (val, is_terminal) in grammar[name])
+            renamed[name] = self.add_rule(rhs)
+        return renamed[lhs]
+
+    def add_rule(self, rhs: tuple) -> str:
+        name = self.rule_ids.get(rhs)
+        if name is None:
+            name = "%s%d" % (GrammarMerger.RULE_PREFIX, len(self.rules) + 1)
+            self.rule_ids[rhs] = name
+            self.rules.append((name, rhs))
+        return name
+
+    def add_grammar(self, grammar: dict):
+        renamed = dict()
+        start_rhs = grammar[Sequitur.START_SYMBOL]
+        for (val, is_terminal) in start_rhs:
+            if not is_terminal:
+                self.merge_rule(grammar, val, renamed)
+        self.start_alternatives.append(
+            [(val, True) if is_terminal else (renamed[val], False) for (val, is_terminal) in start_rhs])
+
+    def to_cfg(self) -> CFG:
+        grammar = CFG()
+        grammar.rules[CFG.START_SYMBOL] = [[Symbol(val, is_terminal) for (val, is_terminal) in rhs]
+                                           for rhs in self.start_alternatives]
+        for name, rhs in self.rules:
+            grammar.rules[name] = [[Symbol(val, is_terminal) for (val, is_terminal) in rhs]]
+        return grammar
+
+
+def merge_grammars(grammars) -> CFG:
+    merger = GrammarMerger()
+    for grammar in grammars:
+        merger.add_grammar(grammar)
+    return merger.to_cfg()
+
+
+def induce_corpus(docs: list, processes=None, num_shards=None) -> CFG:
+    """
+    Induces a grammar for every document of a corpus on a process pool and merges them into one CFG
+    :param docs: list of documents, each a list of terminal symbol values
+    :param processes: size of the process pool (defaults to the number of cores). 1 runs in this process
+    :param num_shards: how many pieces to split the corpus into (defaults to 4 per process)
+    :return: merged CFG with one start alternative per document, in corpus order
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1:
+        return merge_grammars(induce_shard(docs))
+    if num_shards is None:
+        num_shards = 4 * processes
+    with Pool(processes) as pool:
+        shard_grammars = pool.map(induce_shard, shard_corpus(docs, num_shards))
+    return merge_grammars(grammar for shard in shard_grammars for grammar in shard)
+
+
+if __name__ == '__main__':
+    # one document per line
+    with open(sys.argv[1], 'r') as fh:
+        corpus = [line.split() for line in fh if len(line.strip()) > 0]
+    print(str(induce_corpus(corpus)))
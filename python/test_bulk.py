@@ -0,0 +1,51 @@
+from unittest import TestCase, skipIf
+from cfg import CFG, Symbol
+try:
+    import numpy as np
+    from bulk import BulkSampler
+except ImportError:
+    np = None
+
+
+@skipIf(np is None, "numpy is not installed")
+class TestBulkSampler(TestCase):
+
+    @staticmethod
+    def grammar():
+        # _S_ -> a X c | d,  X -> b | b X | <empty>
+        return CFG.from_dict({CFG.START_SYMBOL: [[Symbol('a', True), Symbol('X', False), Symbol('c', True)],
+                                                 [Symbol('d', True)]],
+                              'X': [[Symbol('b', True)], [Symbol('b', True), Symbol('X', False)], []]})
+
+    def test_sample_order_and_offsets(self):
+        sampler = BulkSampler(self.grammar().compile(), seed=0)
+        (tokens, offsets) = sampler.sample(2000)
+        self.assertEqual(len(offsets), 2001)
+        self.assertEqual(offsets[-1], len(tokens))
+        sents = sampler.decode(tokens, offsets)
+        for sent in sents:
+            self.assertRegex(sent, r'^(a( b)* c|d)$')
+        self.assertAlmostEqual(sents.count('d') / len(sents), 0.5, delta=0.05)
+
+    def test_seeded(self):
+        compiled = self.grammar().compile()
+        (t1, o1) = BulkSampler(compiled, seed=4).sample(100)
+        (t2, o2) = BulkSampler(compiled, seed=4).sample(100)
+        self.assertTrue(np.array_equal(t1, t2) and np.array_equal(o1, o2))
+
+    def test_weights(self):
+        compiled = self.grammar().compile(weights={CFG.START_SYMBOL: [1, 0]})
+        sampler = BulkSampler(compiled, seed=1)
+        sents = sampler.decode(*sampler.sample(500))
+        self.assertNotIn('d', sents)
+
+    def test_to_matrix(self):
+        tokens = np.array([3, 4, 5, 6])
+        offsets = np.array([0, 3, 3, 4])
+        mat = BulkSampler.to_matrix(tokens, offsets)
+        self.assertEqual(mat.tolist(), [[3, 4, 5], [-1, -1, -1], [6, -1, -1]])
+
+    def test_batches(self):
+        sampler = BulkSampler(self.grammar().compile(), seed=2)
+        batches = list(sampler.sample_batches(250, batch_size=100))
+        self.assertEqual([len(offsets) - 1 for (_, offsets) in batches], [100, 100, 50])
@@ -0,0 +1,386 @@
+import json
+import math
+import os
+import pickle
+import random
+import tempfile
+from unittest import TestCase
+from cfg import CFG, Symbol, AliasTable
+from sequitur import Sequitur
+
+
+class TestCFG(TestCase):
+    GRAMMAR_FILE = os.path.join(os.path.dirname(__file__), '..', 'resources', 'simplegrammar.cfg')
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def load_simple_grammar(self):
+        grammar = CFG()
+        grammar.load(self.GRAMMAR_FILE)
+        # the grammar file uses S as its start symbol
+        grammar.rules[CFG.START_SYMBOL] = grammar.rules['S']
+        return grammar
+
+    def binary_round_trip(self, grammar):
+        filename = os.path.join(self.tmpdir.name, 'grammar.bin')
+        grammar.save_binary(filename)
+        return CFG.load_binary(filename)
+
+    def test_binary_round_trip(self):
+        grammar = CFG()
+        grammar.load(self.GRAMMAR_FILE)
+        loaded = self.binary_round_trip(grammar)
+        self.assertEqual(json.dumps(loaded.to_serializable(), indent=4, sort_keys=True),
+                         json.dumps(grammar.to_serializable(), indent=4, sort_keys=True))
+        self.assertEqual(str(loaded), str(grammar))
+        for lhs in grammar.rules.keys():
+            for alt, loaded_alt in zip(grammar.rules[lhs], loaded.rules[lhs]):
+                self.assertEqual([s.is_terminal for s in alt], [s.is_terminal for s in loaded_alt])
+
+    def test_binary_round_trip_sequitur(self):
+        s = Sequitur()
+        s.consume_sequence('the cat sat on the mat and the cat sat on the hat'.split())
+        grammar = CFG.from_dict(Sequitur.to_serializable(s))
+        loaded = self.binary_round_trip(grammar)
+        self.assertEqual(loaded.to_serializable(), grammar.to_serializable())
+
+    def test_binary_round_trip_non_ascii(self):
+        grammar = CFG.from_dict({CFG.START_SYMBOL: [[Symbol('café', True), Symbol('naïve', True), Symbol('X', False)]],
+                                 'X': [[Symbol('bar', True)]]})
+        loaded = self.binary_round_trip(grammar)
+        self.assertEqual(loaded.to_serializable(), {CFG.START_SYMBOL: [['café', 'naïve', 'X']], 'X': [['bar']]})
+
+    def test_binary_rules_load_lazily(self):
+        grammar = CFG()
+        grammar.load(self.GRAMMAR_FILE)
+        loaded = self.binary_round_trip(grammar)
+        self.assertEqual(len(loaded.rules.loaded), 0)
+        self.assertEqual([str(s) for s in loaded.rules['PP'][0]], ['<P>', '<CN>'])
+        self.assertEqual(list(loaded.rules.loaded.keys()), ['PP'])
+        self.assertEqual(loaded.rules['missing'], '')
+        self.assertNotIn('missing', loaded.rules)
+
+    def test_binary_rules_mutable(self):
+        loaded = self.binary_round_trip(CFG.from_dict({CFG.START_SYMBOL: [[Symbol('a', True)]],
+                                                       'X': [[Symbol('b', True)]]}))
+        loaded.rules['Y'] = [[Symbol('c', True)]]
+        del loaded.rules['X']
+        self.assertEqual(sorted(loaded.rules.keys()), sorted([CFG.START_SYMBOL, 'Y']))
+        self.assertEqual(len(loaded.rules), 2)
+
+    def test_binary_compile_matches_dict_compile(self):
+        grammar = self.load_simple_grammar()
+        loaded = self.binary_round_trip(grammar)
+        compiled, loaded_compiled = grammar.compile(), loaded.compile()
+        for table in ['nonterminals', 'terminals', 'nt_alts', 'alt_rhs', 'rhs']:
+            self.assertEqual(list(getattr(loaded_compiled, table)), list(getattr(compiled, table)))
+        # once the rules are edited they are compiled from their dict form
+        loaded.rules['VP'] = [[Symbol('runs', True)]]
+        self.assertIn('runs', loaded.compile().terminals)
+
+    def test_generate_matches_recursive_expansion(self):
+        grammar = self.load_simple_grammar()
+        random.seed(3)
+        recursive = [' '.join(sym.val for sym in CFG.flatten(grammar.get_next(Symbol(CFG.START_SYMBOL, False))))
+                     for _ in range(20)]
+        random.seed(3)
+        self.assertEqual([g['flat'] for g in grammar.generate_many(20)], recursive)
+
+    def test_generate_many_seeded(self):
+        grammar = self.load_simple_grammar()
+        gens = grammar.generate_many(10, rng=7)
+        self.assertEqual(gens, grammar.generate_many(10, rng=random.Random(7)))
+        self.assertTrue(all('tree' not in g for g in gens))
+
+    def test_generate_tree(self):
+        grammar = self.load_simple_grammar()
+        gen = grammar.generate(rng=random.Random(1))
+
+        def leaves(node):
+            if 'children' not in node:
+                return [node['name']]
+            return [leaf for child in node['children'] for leaf in leaves(child)]
+
+        self.assertEqual(' '.join(leaves(gen['tree'])), gen['flat'])
+
+    def test_generate_deep_grammar(self):
+        depth = 5000
+        grammar = CFG.from_dict(dict(('R%d' % i, [[Symbol('R%d' % (i + 1), False)]]) for i in range(depth)))
+        grammar.rules['R%d' % depth] = [[Symbol('x', True)]]
+        grammar.rules[CFG.START_SYMBOL] = [[Symbol('R0', False), Symbol('y', True)]]
+        self.assertEqual(grammar.generate_many(1)[0]['flat'], 'x y')
+
+    def test_compile_tables(self):
+        grammar = self.load_simple_grammar()
+        compiled = grammar.compile()
+        self.assertEqual(compiled.nonterminals[0], CFG.START_SYMBOL)
+        for i, lhs in enumerate(compiled.nonterminals):
+            self.assertEqual(compiled.nt_alts[i + 1] - compiled.nt_alts[i], len(grammar.rules[lhs]))
+        for gen in compiled.generate_many(50, rng=1):
+            self.assertTrue(all(w in compiled.terminals for w in gen['flat'].split()))
+
+    def test_compile_rejects_undefined(self):
+        grammar = CFG.from_dict({CFG.START_SYMBOL: [[Symbol('A', False), Symbol('B', False)]],
+                                 'A': [[Symbol('a', True)]]})
+        with self.assertRaises(Exception) as cm:
+            grammar.compile()
+        self.assertIn('B', str(cm.exception))
+
+    def test_compile_weights(self):
+        grammar = CFG.from_dict({CFG.START_SYMBOL: [[Symbol('a', True)], [Symbol('b', True)],
+                                                    [Symbol('c', True)]]})
+        compiled = grammar.compile(weights={CFG.START_SYMBOL: [0, 3, 1]})
+        gens = [g['flat'] for g in compiled.generate_many(4000, rng=3)]
+        self.assertEqual(gens.count('a'), 0)
+        self.assertAlmostEqual(gens.count('b') / len(gens), 0.75, delta=0.03)
+        with self.assertRaises(Exception):
+            grammar.compile(weights={CFG.START_SYMBOL: [1, 1]})
+
+    def text_round_trip(self, grammar):
+        loaded = CFG()
+        loaded.load_lines(str(grammar).splitlines())
+        return loaded
+
+    def test_text_round_trip(self):
+        grammar = self.load_simple_grammar()
+        self.assertEqual(self.text_round_trip(grammar).to_serializable(), grammar.to_serializable())
+
+    def test_text_round_trip_sequitur(self):
+        s = Sequitur()
+        s.consume_sequence('The 2 cats sat , The 2 cats sat on Mat'.split())
+        grammar = CFG.from_dict(Sequitur.to_serializable(s))
+        self.assertEqual(self.text_round_trip(grammar).to_serializable(), grammar.to_serializable())
+
+    def test_load_format(self):
+        grammar = CFG()
+        grammar.load_lines(['# a comment', '', 'S -> <NP> v | v',
+                            '  | w <NP>', 'NP -> the \\', '  n', 'NP -> a n'])
+        self.assertEqual([[str(s) for s in alt] for alt in grammar.rules['S']],
+                         [['<NP>', 'v'], ['v'], ['w', '<NP>']])
+        self.assertEqual([[s.val for s in alt] for alt in grammar.rules['NP']], [['the', 'n'], ['a', 'n']])
+        # symbols are interned
+        self.assertIs(grammar.rules['S'][0][0], grammar.rules['S'][2][1])
+
+    def test_load_documented_format(self):
+        grammar = CFG()
+        grammar.load_lines(['LHS -> a B | c <D>      # alternatives separated by |, <D> is always a nonterminal',
+                            '     | e                # a line starting with | adds alternatives to the previous rule',
+                            'E -> f \\                # a trailing backslash continues the line',
+                            '     g | ε              # ε is the empty alternative'], validate=False)
+        self.assertEqual([[str(s) for s in alt] for alt in grammar.rules['LHS']], [['a', '<B>'], ['c', '<D>'], ['e']])
+        self.assertEqual([[str(s) for s in alt] for alt in grammar.rules['E']], [['f', 'g'], []])
+
+    def test_text_round_trip_empty_alternatives(self):
+        grammar = CFG.from_dict({CFG.START_SYMBOL: [[Symbol('a', True), Symbol('A', False)], []],
+                                 'A': [[], [Symbol('#', True), Symbol('ε', True), Symbol('#b', True)]]})
+        self.assertEqual(self.text_round_trip(grammar).to_serializable(), grammar.to_serializable())
+
+    def test_load_errors(self):
+        with self.assertRaises(Exception) as cm:
+            CFG().load_lines(['S -> a', 'B a'], source='g.cfg')
+        self.assertIn('g.cfg:2', str(cm.exception))
+        with self.assertRaises(Exception) as cm:
+            CFG().load_lines(['S -> a <B>', '', 'A -> <C>'], source='g.cfg')
+        self.assertIn('B (line 1), C (line 3)', str(cm.exception))
+        grammar = CFG()
+        grammar.load_lines(['S -> a <B>'], validate=False)
+        self.assertEqual(len(grammar.rules['S'][0]), 2)
+
+    def test_symbols_interned(self):
+        a = Symbol('cat', True)
+        self.assertIs(Symbol('cat', True), a)
+        self.assertIs(Symbol("'cat'", True), a)
+        self.assertIsNot(Symbol('cat', False), a)
+        self.assertNotEqual(Symbol('cat', False), a)
+        self.assertEqual(len({a, Symbol('cat', True), Symbol('dog', True)}), 2)
+        self.assertIs(pickle.loads(pickle.dumps(a)), a)
+        with self.assertRaises(Exception):
+            a.val = 'dog'
+
+    def test_symbol_table_weak(self):
+        sym = Symbol("'unused symbol'", True)
+        self.assertIs(Symbol.table[('unused symbol', True)](), sym)
+        # only the cleaned value is interned
+        self.assertNotIn(("'unused symbol'", True), Symbol.table)
+        del sym
+        self.assertIsNone(Symbol.table[('unused symbol', True)]())
+        Symbol.purge()
+        self.assertNotIn(('unused symbol', True), Symbol.table)
+
+    def test_analyze(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> <A> | <B> <B>', 'A -> <A> | <A> a', 'B -> b | <B> <B> <B>'])
+        compiled = grammar.compile().analyze()
+        stats = compiled.derivation_stats()
+        self.assertEqual(stats['A']['min_length'], float('inf'))
+        self.assertEqual(stats['A']['termination_probability'], 0.0)
+        self.assertEqual(stats['B']['min_depth'], 1)
+        self.assertEqual(stats[CFG.START_SYMBOL]['min_length'], 2)
+        self.assertEqual(stats[CFG.START_SYMBOL]['min_depth'], 2)
+        # A never terminates, B does with probability q = 1/2 + q^3/2, i.e. q = (sqrt(5) - 1) / 2
+        self.assertAlmostEqual(stats[CFG.START_SYMBOL]['termination_probability'], 0.5 * ((5 ** 0.5 - 1) / 2) ** 2,
+                               places=6)
+        self.assertEqual(stats[CFG.START_SYMBOL]['expected_length'], float('inf'))
+        # B -> b | B B B with weights 3:1 is subcritical, E = 3/4 + 1/4 * 3E
+        compiled = grammar.compile(start='B', weights={'B': [3, 1]}).analyze()
+        self.assertAlmostEqual(compiled.expected_length[0], 3.0, places=6)
+        self.assertAlmostEqual(compiled.termination_probability[0], 1.0, places=6)
+
+    def test_analyze_deep_chain(self):
+        # N0 -> a N1, ..., N11999 -> a B, with B -> b | B B B weighted 3:1 at the bottom
+        rules = dict(('N%d' % i, [[Symbol('a', True), Symbol('N%d' % (i + 1) if i < 11999 else 'B', False)]])
+                     for i in range(12000))
+        rules['B'] = [[Symbol('b', True)], [Symbol('B', False)] * 3]
+        rules[CFG.START_SYMBOL] = [[Symbol('N0', False)]]
+        compiled = CFG.from_dict(rules).compile(weights={'B': [3, 1]}).analyze(max_iterations=1000)
+        self.assertEqual(compiled.min_length[0], 12001)
+        self.assertEqual(compiled.min_depth[0], 12002)
+        self.assertAlmostEqual(compiled.termination_probability[0], 1.0, places=6)
+        self.assertAlmostEqual(compiled.expected_length[0], 12003.0, places=4)
+
+    def test_analyze_warns_when_unsettled(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> <B>', 'B -> <B> | b'])
+        with self.assertWarns(UserWarning):
+            compiled = grammar.compile(weights={'B': [1000000, 1]}).analyze()
+        self.assertLess(compiled.termination_probability[0], 0.5)
+
+    def test_sample_bounded(self):
+        grammar = CFG()
+        # supercritical: unbounded sampling would usually never finish
+        grammar.load_lines(['_S_ -> <B> <B>', 'B -> b | <B> <B> <B>'])
+        compiled = grammar.compile(weights={'B': [1, 3]})
+        rng = random.Random(4)
+        lengths = [len(compiled.sample_bounded(25, rng)) for _ in range(300)]
+        self.assertTrue(all(2 <= n <= 25 for n in lengths))
+        self.assertGreater(max(lengths), 20)
+        for gen in compiled.generate_many(20, rng=1, max_length=3):
+            self.assertEqual(gen['flat'], 'b b')
+        grammar.rules['A'] = [[Symbol('A', False)]]
+        grammar.rules[CFG.START_SYMBOL] = [[Symbol('A', False)]]
+        with self.assertRaises(Exception):
+            grammar.compile().sample_bounded(10)
+
+    def test_sample_bounded_empty_cycles(self):
+        grammar = CFG()
+        # no expansion adds a terminal, so only the step cap ends these
+        grammar.load_lines(['_S_ -> <A> a', 'A -> <A> <A> <A> | ε', 'B -> <B> | b'])
+        compiled = grammar.compile(weights={'A': [9, 1]})
+        rng = random.Random(0)
+        for _ in range(20):
+            self.assertEqual(compiled.sample_bounded(5, rng, max_steps=200), [0])
+        compiled = grammar.compile(start='B', weights={'B': [1000000, 1]})
+        self.assertEqual(compiled.decode(compiled.sample_bounded(5, rng, max_steps=50)), ['b'])
+
+    def test_alias_table(self):
+        table = AliasTable([1, 0, 3, 6])
+        rng = random.Random(0)
+        draws = [table.sample(rng) for _ in range(20000)]
+        self.assertEqual(draws.count(1), 0)
+        for i, p in [(0, 0.1), (2, 0.3), (3, 0.6)]:
+            self.assertAlmostEqual(draws.count(i) / len(draws), p, delta=0.02)
+        with self.assertRaises(Exception):
+            AliasTable([0, 0])
+
+    def test_weighted_generation(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> a | b | c'])
+        grammar.set_weights(CFG.START_SYMBOL, [0, 1, 3])
+        gens = [g['flat'] for g in grammar.generate_many(4000, rng=2)]
+        self.assertEqual(gens.count('a'), 0)
+        self.assertAlmostEqual(gens.count('c') / len(gens), 0.75, delta=0.03)
+        # compile picks up the grammar's weights
+        self.assertEqual(grammar.compile().generate_many(50, rng=2).count({'flat': 'a'}), 0)
+        with self.assertRaises(Exception):
+            grammar.set_weights(CFG.START_SYMBOL, [1, 1])
+
+    def test_collapse_duplicates(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> <W> x | <W> x | <W>', 'W -> a | b | a | a'])
+        grammar.collapse_duplicates()
+        self.assertEqual(grammar.to_serializable()['W'], [['a'], ['b']])
+        self.assertEqual(grammar.weights, {CFG.START_SYMBOL: [2, 1], 'W': [3, 1]})
+        # looking up a missing rule leaves an empty entry, which gets no weights
+        self.assertEqual(grammar.rules['missing'], '')
+        grammar.collapse_duplicates()
+        self.assertEqual(grammar.weights, {CFG.START_SYMBOL: [2, 1], 'W': [3, 1]})
+
+    def test_estimate_weights_and_likelihood(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> <E>', 'E -> <E> plus <E> | n'])
+        corpus = [['n'], 'n plus n'.split(), 'n plus n plus n'.split()]
+        # uniform: 1/2, (1/2)^3 and two parses of (1/2)^5
+        self.assertAlmostEqual(grammar.log_likelihood(corpus), math.log(0.5 ** 4 * 2 * 0.5 ** 5))
+        self.assertEqual(grammar.log_likelihood([['plus']]), float('-inf'))
+        self.assertEqual(grammar.estimate_weights(corpus + [['x']]), 3)
+        self.assertEqual(grammar.weights['E'], [3, 6])
+        self.assertAlmostEqual(grammar.log_likelihood([['n']]), math.log(2 / 3))
+
+    def test_estimate_weights_cyclic_forest(self):
+        grammar = CFG()
+        # parses of these sentences contain unit and empty cycles, e.g. N0 over (0, 1) -> _S_ (0, 1) N0 (1, 1)
+        grammar.load_lines(['_S_ -> ε | <N0> <N0> | <N0> b', 'N0 -> ε | <_S_> <N0>'])
+        self.assertEqual(grammar.estimate_weights([['b'], [], ['b', 'b'], ['c']]), 3)
+        self.assertEqual(grammar.weights, {CFG.START_SYMBOL: [1, 1, 3], 'N0': [5, 2]})
+
+    def test_expansion_cache(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> <A> <R>', 'A -> <B> <B> | c', 'B -> a | b', 'R -> r <R> | r'])
+        grammar.set_weights('A', [3, 1])
+        compiled = grammar.compile()
+        cache = compiled.expansion_cache()
+        names = compiled.nonterminals
+        self.assertEqual(dict((names[i], cache.num_derivations[i]) for i in range(len(names))),
+                         {CFG.START_SYMBOL: None, 'A': 5, 'B': 2, 'R': None})
+        (expansions, probs, _) = cache.lookup(names.index('A'))
+        language = dict((' '.join(compiled.decode(e)), p) for e, p in zip(expansions, probs))
+        self.assertEqual(set(language.keys()), {'a a', 'a b', 'b a', 'b b', 'c'})
+        self.assertAlmostEqual(language['c'], 0.25)
+        self.assertAlmostEqual(language['a b'], 0.75 / 4)
+        rng = random.Random(1)
+        sentences = [' '.join(compiled.decode(cache.sample(rng))) for _ in range(4000)]
+        self.assertAlmostEqual(sum(s.startswith('c ') for s in sentences) / len(sentences), 0.25, delta=0.03)
+        report = cache.memory_report()
+        self.assertEqual((report['entries'], report['expansions'], report['symbols']), (2, 7, 11))
+        self.assertGreater(report['bytes'], 0)
+
+    def test_expansion_cache_deep_chain(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> <N0>'] + ['N%d -> a <N%d>' % (i, i + 1) for i in range(3000)] + ['N3000 -> b'])
+        compiled = grammar.compile()
+        cache = compiled.expansion_cache(max_symbols=10 ** 7)
+        (expansions, probs, _) = cache.lookup(0)
+        self.assertEqual(compiled.decode(expansions[0]), ['a'] * 3000 + ['b'])
+        self.assertEqual(len(cache.entries), 3002)
+        self.assertEqual(list(cache.entries.keys())[-1], 0)
+
+    def test_expansion_cache_deep_chain_over_limit(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> <N0>'] + ['N%d -> a <N%d>' % (i, i + 1) for i in range(3000)] + ['N3000 -> b'])
+        compiled = grammar.compile()
+        cache = compiled.expansion_cache(max_symbols=1000)
+        # N2001 expands to 1000 terminals, everything above it to more
+        n2000 = compiled.nonterminals.index('N2000')
+        self.assertEqual(cache.derivation_symbols[n2000 + 1], 1000)
+        self.assertFalse(any(cache.cacheable[:n2000 + 1]))
+        self.assertIsNone(cache.lookup(0))
+        self.assertEqual(compiled.decode(cache.sample(random.Random(0))), ['a'] * 3000 + ['b'])
+        self.assertLessEqual(cache.num_symbols, 1000)
+        self.assertEqual(list(cache.entries.keys()), [n2000 + 1])
+
+    def test_expansion_cache_eviction(self):
+        grammar = CFG()
+        grammar.load_lines(['_S_ -> <A> | <B>', 'A -> a a | a', 'B -> b b | b'])
+        compiled = grammar.compile()
+        cache = compiled.expansion_cache(max_symbols=3)
+        (a, b) = (compiled.nonterminals.index('A'), compiled.nonterminals.index('B'))
+        cache.lookup(a)
+        cache.lookup(b)
+        self.assertEqual(list(cache.entries.keys()), [b])
+        self.assertEqual(cache.evictions, 1)
+        # the start symbol has 4 derivations, over the limit
+        self.assertIsNone(compiled.expansion_cache(max_expansions=3).lookup(0))
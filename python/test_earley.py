@@ -0,0 +1,96 @@
+import os
+import sys
+from unittest import TestCase
+from cfg import CFG
+from earley import EarleyParser, parse_corpus
+from sequitur import Sequitur
+
+
+class TestEarley(TestCase):
+    GRAMMAR_FILE = os.path.join(os.path.dirname(__file__), '..', 'resources', 'mygrammar.cfg')
+
+    @staticmethod
+    def grammar(lines):
+        grammar = CFG()
+        grammar.load_lines(lines)
+        return grammar
+
+    @staticmethod
+    def leaves(tree):
+        return [x for child in tree[1] for x in (TestEarley.leaves(child) if isinstance(child, tuple) else [child])]
+
+    def test_recognize_generated(self):
+        grammar = CFG()
+        grammar.load(self.GRAMMAR_FILE)
+        parser = EarleyParser(grammar, 'S')
+        grammar.rules[CFG.START_SYMBOL] = grammar.rules['S']
+        sentences = [gen['flat'].split() for gen in grammar.compile().generate_many(200, rng=5)]
+        for sentence in sentences:
+            self.assertTrue(parser.recognize(sentence))
+            self.assertFalse(parser.recognize(sentence[:-1]))
+            self.assertEqual(self.leaves(parser.parse(sentence).tree()), sentence)
+        self.assertFalse(parser.recognize(sentences[0] + ['unknownword']))
+
+    def test_left_recursion_and_ambiguity(self):
+        parser = EarleyParser(self.grammar(['_S_ -> <E>', 'E -> <E> plus <E> | n']))
+        self.assertTrue(parser.recognize('n plus n plus n'.split()))
+        self.assertFalse(parser.recognize('n plus'.split()))
+        forest = parser.parse('n plus n plus n'.split())
+        self.assertTrue(forest.is_ambiguous())
+        self.assertEqual(len(forest.nodes[('E', 0, 5)]), 2)
+        self.assertFalse(parser.parse('n plus n'.split()).is_ambiguous())
+
+    def test_nullable(self):
+        grammar = self.grammar(['_S_ -> <A> <B> c <A>', 'A -> a <A>', 'B -> <A> | b'])
+        grammar.rules['A'].append([])
+        parser = EarleyParser(grammar)
+        self.assertEqual(parser.nullable, [False, True, True])
+        for sentence in ['c', 'a c', 'b c a a', 'a a b c']:
+            self.assertTrue(parser.recognize(sentence.split()), sentence)
+        for sentence in ['', 'b b c', 'c b']:
+            self.assertFalse(parser.recognize(sentence.split()), sentence)
+        self.assertEqual(self.leaves(parser.parse(['c']).tree()), ['c'])
+
+    def test_tree_skips_cyclic_derivations(self):
+        # the first derivation of ('N0', 0, 1) loops back through _S_ over the same span
+        parser = EarleyParser(self.grammar(['_S_ -> ε | <N0> <N0> | <N0> b', 'N0 -> ε | <_S_> <N0>']))
+        forest = parser.parse(['b'])
+        self.assertEqual(self.leaves(forest.tree()), ['b'])
+
+    def test_tree_deep_parse(self):
+        grammar = self.grammar(['_S_ -> <R>', 'R -> r <R> | r'])
+        sentence = ['r'] * 500
+        # the parse is deeper than the stack this test leaves itself
+        frame, stack_depth = sys._getframe(), 0
+        while frame is not None:
+            frame, stack_depth = frame.f_back, stack_depth + 1
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(stack_depth + 100)
+        try:
+            tree = EarleyParser(grammar).parse(sentence).tree()
+            self.assertEqual(grammar.estimate_weights([sentence]), 1)
+        finally:
+            sys.setrecursionlimit(limit)
+        depth = 0
+        while isinstance(tree, tuple):
+            depth += 1
+            tree = tree[1][-1]
+        self.assertEqual(depth, 501)
+        self.assertEqual(grammar.weights['R'], [499, 1])
+
+    def test_sequitur_grammar(self):
+        s = Sequitur()
+        s.consume_sequence('a b c a b d a b c a b d'.split())
+        parser = EarleyParser(CFG.from_dict(Sequitur.to_serializable(s)), Sequitur.START_SYMBOL)
+        self.assertTrue(parser.recognize('a b c a b d a b c a b d'.split()))
+        self.assertFalse(parser.recognize('a b c a b d'.split()))
+
+    def test_parse_corpus(self):
+        grammar = self.grammar(['_S_ -> <E>', 'E -> <E> plus <E> | n'])
+        sentences = [['n'] + ['plus', 'n'] * k for k in range(10)] + [['plus'], ['n', 'n']]
+        serial = parse_corpus(grammar, sentences, processes=1)
+        self.assertEqual(serial, [True] * 10 + [False, False])
+        self.assertEqual(parse_corpus(grammar, sentences, processes=2, chunk_size=3), serial)
+        forests = parse_corpus(grammar, sentences[:3], processes=2, want_forest=True, chunk_size=1)
+        self.assertEqual(forests[2].root, ('_S_', 0, 5))
+        self.assertEqual(parse_corpus(grammar, sentences, processes=2, chunk_size=3, start_method='spawn'), serial)
@@ -1,5 +1,6 @@
 from unittest import TestCase
 from metagrammar import *
+from earley import EarleyParser
 
 
 class TestMetaGrammar(TestCase):
@@ -38,16 +39,128 @@ class TestMetaGrammar(TestCase):
 
     def test_replace_all_instances(self):
         sym = Symbol('X', False)
-        l1 = [Symbol(x, True) for x in [1, 2, 1, 2]]
-        self.assertListEqual(MetaGrammar.replace_all_instances(l1, l1[0:2], sym), [sym, sym])
-        l2 = [Symbol(x, True) for x in [1, 2, 0, 2]]
-        self.assertListEqual(MetaGrammar.replace_all_instances(l2, l2[0:2], sym),
-                             [sym, Symbol(0, True), Symbol(2, True)])
-        l3 = [Symbol(x, True) for x in [0, 2, 0, 2]]
-        self.assertListEqual(MetaGrammar.replace_all_instances(l3, l2[0:2], sym), l3)
-        self.assertListEqual(MetaGrammar.replace_all_instances([0, 2, 0, 2], [0, 2, 0], sym), [sym, 2])
-        self.assertListEqual(MetaGrammar.replace_all_instances([0, 2, 0, 2, 1, 2, 0, 1, 2], [1, 2], sym),
-                             [0, 2, 0, 2, sym, 0, sym])
+        l1 = [Symbol(x, True) for x in ['1', '2', '1', '2']]
+        self.assertEqual(MetaGrammar.replace_all_instances(l1, l1[0:2], sym), ([sym, sym], []))
+        l2 = [Symbol(x, True) for x in ['1', '2', '0', '2']]
+        self.assertEqual(MetaGrammar.replace_all_instances(l2, l2[0:2], sym),
+                         ([sym, Symbol('0', True), Symbol('2', True)], []))
+        l3 = [Symbol(x, True) for x in ['0', '2', '0', '2']]
+        self.assertEqual(MetaGrammar.replace_all_instances(l3, l2[0:2], sym), (l3, []))
+        (s0, s1, s2) = [Symbol(x, True) for x in ['0', '1', '2']]
+        self.assertEqual(MetaGrammar.replace_all_instances([s0, s2, s0, s2], [s0, s2, s0], sym), ([sym, s2], []))
+        self.assertEqual(MetaGrammar.replace_all_instances([s0, s2, s0, s2, s1, s2, s0, s1, s2], [s1, s2], sym),
+                         ([s0, s2, s0, s2, sym, s0, sym], []))
+
+    def test_replace_all_instances_wildcards(self):
+        sym = Symbol('X', False)
+        wild = PatternTemplate.WILDCARD_SYMBOL
+        seq = [Symbol(x, True) for x in 'a b a c b'.split()] * 1000
+        (new_seq, wildcard_vals) = MetaGrammar.replace_all_instances(seq, [Symbol('a', True), wild], sym)
+        self.assertEqual(new_seq, [sym, sym, Symbol('b', True)] * 1000)
+        self.assertEqual([w.val for w in wildcard_vals[:3]], ['b', 'c', 'b'])
+        self.assertEqual(len(wildcard_vals), 2000)
+        self.assertEqual(MetaGrammar.replace_all_instances(seq[:3], [wild, Symbol('d', True)], sym), (seq[:3], []))
+
+    @staticmethod
+    def record_positions(metagram):
+        return [(k, [(gp.lhs, gp.rhs_begin, gp.rhs_end) for gp in mr.grammar_positions])
+                for k, mr in metagram.match_records.items()]
+
+    def test_match_sequence_same_as_templates(self):
+        pats = ['xy', 'xyx', 'x*', 'xy*y', 'xx']
+        seqs = [('S', list('abcbabcbbaab')), ('T', list('aabab')), ('U', list('ccbcb'))]
+        templates = MetaGrammar(pats)
+        compiled = MetaGrammar(pats)
+        for lhs, seq in seqs:
+            templates.consume_sequence(seq, lhs)
+            templates.reset_all_pattern_templates()
+            compiled.match_sequence(seq, lhs)
+        self.assertEqual(self.record_positions(compiled), self.record_positions(templates))
+        self.assertEqual(compiled.match_records['a.b.*.b'].get_num_matches(), 2)
+        # no template is left half way through a sequence to carry on into the next one
+        self.assertTrue(all(pos[1] >= 0 for _, positions in self.record_positions(templates) for pos in positions))
+
+    def test_incremental_matches(self):
+        metagram = MetaGrammar(['x*', 'xyx'])
+        metagram.initialize('a b c a b. c a b c. d e d e. a b')
+        metagram.get_matches()
+        while metagram.matches_found():
+            metagram.replace_matches()
+            metagram.get_matches()
+            rescanned = MetaGrammar(['x*', 'xyx'])
+            rescanned.grammar = metagram.grammar
+            rescanned.get_matches()
+            self.assertEqual([(k, [str(s) for s in metagram.match_records[k].match_sequence])
+                              for k in metagram.ordered_match_keys()],
+                             [(k, [str(s) for s in rescanned.match_records[k].match_sequence])
+                              for k in rescanned.ordered_match_keys()])
+            self.assertEqual(dict(self.record_positions(metagram)), dict(self.record_positions(rescanned)))
+
+    def test_pattern_matcher(self):
+        matcher = PatternMatcher(['xyx', 'x*'])
+        self.assertEqual(matcher.find(list('abac')), [(1, 0, 1), (0, 0, 2), (1, 1, 2), (1, 2, 3)])
+        self.assertEqual(matcher.find(list('aaa')), [])
+
+    def test_pattern_replacer(self):
+        wild = PatternTemplate.WILDCARD_SYMBOL
+        replacer = PatternReplacer([(['a', 'b'], 'P'), (['a', 'b', 'c'], 'Q'), (['d', wild], 'W')])
+        # the higher priority pattern is tried first at every position, so it wins where both start
+        self.assertEqual(replacer.replace(list('abcxdade')), ['P', 'c', 'x', 'W', 'W'])
+        self.assertIsNone(replacer.replace(list('cba')))
+        self.assertEqual(replacer.wildcard_values[2], ['a', 'e'])
+        self.assertEqual(replacer.num_replaced, [1, 0, 2])
+        # a higher priority occurrence wins over an overlapping one to its left
+        replacer = PatternReplacer([(list('bc'), 'HI'), (list('ab'), 'LO')])
+        self.assertEqual(replacer.replace(list('abc')), ['a', 'HI'])
+        self.assertEqual(replacer.replace(list('abcab')), ['a', 'HI', 'LO'])
+
+    def test_replace_matches_new_rules_used_twice(self):
+        metagram = MetaGrammar(['xy'])
+        metagram.initialize('a b c. z a b. x b c')
+        metagram.get_matches()
+        metagram.replace_matches()
+        # b c overlaps a b in the first sentence, which has priority, and is left with a single occurrence
+        sentences = metagram.grammar.rules['_S_']
+        new_rule = sentences[0][0]
+        self.assertEqual([[str(s) for s in rhs] for rhs in sentences],
+                         [[str(new_rule), 'c'], ['z', str(new_rule)], ['x', 'b', 'c']])
+        self.assertEqual([[str(s) for s in rhs] for rhs in metagram.grammar.rules[new_rule.val]], [['a', 'b']])
+        self.assertEqual(len(metagram.grammar.rules), 2)
+
+    def test_replace_matches_wildcard_rule(self):
+        metagram = MetaGrammar(['x*'])
+        metagram.initialize('a b. a b. a c')
+        metagram.get_matches()
+        metagram.replace_matches()
+        wildcard_rules = [lhs for lhs, rhss in metagram.grammar.rules.items() if lhs != '_S_' and len(rhss) > 1]
+        self.assertEqual([[[str(s) for s in rhs] for rhs in metagram.grammar.rules[lhs]] for lhs in wildcard_rules],
+                         [[['b'], ['c']]])
+        # b stood for two matches, c for one
+        self.assertEqual([metagram.grammar.weights[lhs] for lhs in wildcard_rules], [[2, 1]])
+
+    def test_replace_matches_wildcard_rule_weights(self):
+        metagram = MetaGrammar(['x*'])
+        metagram.initialize('the cat. the cat. the cat. the dog')
+        metagram.get_matches()
+        metagram.replace_matches()
+        wildcard_rules = [lhs for lhs, rhss in metagram.grammar.rules.items() if lhs != '_S_' and len(rhss) > 1]
+        self.assertEqual(len(wildcard_rules), 1)
+        self.assertEqual([str(rhs[0]) for rhs in metagram.grammar.rules[wildcard_rules[0]]], ['cat', 'dog'])
+        self.assertEqual(metagram.grammar.weights[wildcard_rules[0]], [3, 1])
+        metagram.weight_alternatives()
+        self.assertEqual(metagram.grammar.weights[wildcard_rules[0]], [3, 1])
+
+    def test_replace_matches_keeps_sentences(self):
+        metagram = MetaGrammar(['xy', 'x*'])
+        metagram.initialize('a b c. a b d. e c. e d')
+        sentences = [[sym.val for sym in rhs] for rhs in metagram.grammar.rules['_S_']]
+        metagram.get_matches()
+        while metagram.matches_found():
+            metagram.replace_matches()
+            metagram.get_matches()
+        parser = EarleyParser(metagram.grammar, '_S_')
+        for sentence in sentences:
+            self.assertTrue(parser.recognize(sentence))
 
 
 class TestPatternTemplate(TestCase):
@@ -72,3 +185,63 @@ class TestPatternTemplate(TestCase):
             print(i)
             PatternTemplate.get_uid()
         self.assertTrue(True)
+
+
+class TestMatchRecord(TestCase):
+    def test_non_overlapping_count(self):
+        # xyx over abababa: a.b.a at 0, 2 and 4. 0-2 overlaps 2-4 and 2-4 overlaps 4-6 but 0-2 and 4-6 don't,
+        # so two of them can be replaced
+        mr = MatchRecord(list('aba'), 'S', 0, 2, 0)
+        mr.add_new_position('S', 2, 4, 0)
+        mr.add_new_position('S', 4, 6, 0)
+        self.assertEqual(mr.get_num_matches(), 2)
+        # the same spans in another alternative, or another rule, don't overlap these
+        mr.add_new_position('S', 0, 2, 1)
+        mr.add_new_position('T', 2, 4, 0)
+        self.assertEqual(mr.get_num_matches(), 4)
+        self.assertEqual(len(MatchRecord.dedupe_grammar_positions(mr.grammar_positions)), 4)
+
+    def test_count_independent_of_order(self):
+        spans = [(2, 4), (4, 6), (0, 2), (6, 8), (3, 5)]
+        in_order = MatchRecord(list('aba'), 'S', 0, 2)
+        for (b, e) in sorted(spans)[1:]:
+            in_order.add_new_position('S', b, e)
+        shuffled = MatchRecord(list('aba'), 'S', *spans[0])
+        for (b, e) in spans[1:]:
+            shuffled.add_new_position('S', b, e)
+        self.assertEqual(shuffled.get_num_matches(), in_order.get_num_matches())
+        self.assertEqual(shuffled.get_num_matches(), 3)
+        self.assertEqual(len(MatchRecord.dedupe_grammar_positions(shuffled.grammar_positions)), 3)
+
+    def test_remove_positions(self):
+        mr = MatchRecord(list('ab'), 'S', 0, 1, 0)
+        for b in [1, 2, 4]:
+            mr.add_new_position('S', b, b + 1, 0)
+        mr.add_new_position('S', 0, 1, 1)
+        self.assertEqual(mr.get_num_matches(), 4)
+        mr.remove_positions(0, 2)
+        self.assertEqual(mr.get_num_matches(), 3)
+        mr.remove_positions(2, 3)
+        self.assertEqual(mr.get_num_matches(), 2)
+        self.assertEqual([(gp.rhs_begin, gp.alt) for gp in mr.grammar_positions], [(2, 0), (4, 0)])
+
+    def test_dedupe_by_rule_order(self):
+        mr = MatchRecord(list('ab'), '10', 0, 1, 0)
+        mr.add_new_position('9', 0, 1, 0)
+        mr.add_new_position('9', 1, 2, 0)
+        mr.add_new_position('9', 2, 3, 0)
+        deduped = MatchRecord.dedupe_grammar_positions(mr.grammar_positions, {'9': 0, '10': 1})
+        self.assertEqual([(gp.lhs, gp.rhs_begin) for gp in deduped], [('9', 0), ('9', 2), ('10', 0)])
+        mr.remove_positions(1, 3)
+        self.assertEqual(mr.site_spans[('9', 0)], [(2, 3)])
+        self.assertEqual(mr.get_num_matches(), 2)
+
+    def test_grammar_position(self):
+        gp = GrammarPosition('S', 0, 2, 0)
+        self.assertEqual(gp, GrammarPosition('S', 0, 2, 0))
+        self.assertNotEqual(gp, GrammarPosition('S', 1, 3, 0))
+        self.assertTrue(gp.overlaps(GrammarPosition('S', 1, 3, 0)))
+        self.assertTrue(GrammarPosition('S', 1, 3, 0).overlaps(gp))
+        self.assertFalse(gp.overlaps(GrammarPosition('S', 1, 3, 1)))
+        self.assertFalse(gp.overlaps(GrammarPosition('S', 3, 5, 0)))
+        self.assertEqual(len({gp, GrammarPosition('S', 0, 2, 0)}), 1)
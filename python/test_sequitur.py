@@ -1,5 +1,7 @@
+import io
+from contextlib import redirect_stdout
 from unittest import TestCase
-from sequitur import Sequitur
+from sequitur import Sequitur, Node, Event
 
 
 class TestSequitur(TestCase):
@@ -12,3 +14,146 @@ class TestSequitur(TestCase):
     #    seq = list('bcbcbcbcabcabcabdfbcdfbdfa')
     #    Sequitur.run(seq)
     #    self.assertEqual(True, True)
+
+    def test_rule_tails_track_rule_ends(self):
+        seq = list('abcabdabcabdbcbcaab')
+        s = Sequitur()
+        s.consume_sequence(seq)
+        for rule in Sequitur.get_rules(s.get_start_rule_node()):
+            self.assertIs(rule.get_tail(), Sequitur.get_rule_end_node(rule))
+
+    def test_append_to_start_rule(self):
+        s = Sequitur()
+        self.assertTrue(s.start_rule_empty())
+        for val in 'abc':
+            s.append_to_start_rule(Node(s.symbols.intern(val), is_terminal=True))
+        self.assertFalse(s.start_rule_empty())
+        self.assertEqual(s.get_start_rule_string(), 'S->a b c ')
+        self.assertEqual(s.symbols.decode(s.get_start_rule_node().get_tail().get_data()), 'c')
+
+    def test_consume_sequence_quiet(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            Sequitur.run(list('abcabdabcabd'))
+        self.assertEqual(out.getvalue(), '')
+
+    def test_hooks_and_counters(self):
+        created = []
+        reused = []
+        s = Sequitur()
+        s.add_hook(Event.RuleCreated, created.append)
+        s.add_hook(Event.RuleReused, reused.append)
+        s.consume_sequence(list('abcabcabc'))
+        counters = s.get_counters()
+        self.assertEqual(counters[Event.SymbolConsumed], 9)
+        self.assertEqual(counters[Event.RuleCreated], len(created))
+        self.assertEqual(counters.get(Event.RuleReused, 0), len(reused))
+        self.assertEqual(len(created) - counters.get(Event.RuleInlined, 0),
+                         len(Sequitur.get_rules(s.get_start_rule_node())) - 1)
+        self.assertGreater(counters[Event.DigramIndexed], 0)
+
+    @staticmethod
+    def expand(rules, lhs='S'):
+        vals = []
+        for sym in rules[lhs][0]:
+            vals.extend([sym.val] if sym.is_terminal else TestSequitur.expand(rules, sym.val))
+        return vals
+
+    def test_feed_from_generator(self):
+        seq = list('abcabdabcabdbcbc')
+        s = Sequitur()
+        s.feed_many(c for c in seq)
+        self.assertEqual(self.expand(s.snapshot()), seq)
+
+    def test_snapshot_while_feeding(self):
+        seq = list('abcabdabcabdbcbc')
+        s = Sequitur()
+        s.feed_many(iter(seq[:8]))
+        snap = s.snapshot()
+        for val in seq[8:]:
+            s.feed(val)
+        self.assertEqual(self.expand(snap), seq[:8])
+        self.assertEqual(self.expand(s.snapshot()), seq)
+
+    @staticmethod
+    def rule_uses(rules):
+        uses = dict()
+        for rhs in rules.values():
+            for sym in rhs[0]:
+                if not sym.is_terminal:
+                    uses[sym.val] = uses.get(sym.val, 0) + 1
+        return uses
+
+    def test_rule_utility(self):
+        seq = list('abcdbcabcdbc')
+        s = Sequitur()
+        s.consume_sequence(seq)
+        rules = s.snapshot()
+        uses = self.rule_uses(rules)
+        self.assertEqual(self.expand(rules), seq)
+        self.assertEqual(uses, dict((s.get_rule_name(k), v) for k, v in s.rule_counts.items()))
+        for lhs in rules.keys():
+            if lhs != Sequitur.START_SYMBOL:
+                self.assertGreaterEqual(uses[lhs], 2)
+        self.assertGreater(s.get_counters()[Event.RuleInlined], 0)
+
+    def test_rule_utility_disabled(self):
+        seq = list('abcdbcabcdbc')
+        s = Sequitur(rule_utility=False)
+        s.consume_sequence(seq)
+        rules = s.snapshot()
+        self.assertEqual(self.expand(rules), seq)
+        self.assertIn(1, self.rule_uses(rules).values())
+
+    def test_node_is_slotted(self):
+        node = Node('a', is_terminal=True)
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertNotEqual(node.get_nodeid(), Node('a', is_terminal=True).get_nodeid())
+
+    def test_digram_keys_do_not_collide(self):
+        seq = ['a.b', 'c', 'a', 'b.c', '[]', 'x', '[]', 'y']
+        s = Sequitur()
+        s.consume_sequence(seq)
+        rules = s.snapshot()
+        self.assertEqual(list(rules.keys()), [Sequitur.START_SYMBOL])
+        self.assertEqual(self.expand(rules), seq)
+
+    def test_symbol_table(self):
+        s = Sequitur()
+        a = s.symbols.intern('a')
+        self.assertEqual(s.symbols.intern('a'), a)
+        self.assertNotEqual(s.symbols.intern(Sequitur.GUARD_SYMBOL), Sequitur.GUARD_ID)
+        self.assertNotEqual(s.symbols.new_id('a'), a)
+        self.assertEqual(s.symbols.decode(a), 'a')
+
+    def test_get_rules_order(self):
+        s = Sequitur()
+        s.consume_sequence(list('abcdbcabcdbcxyzxyzabcdbc'))
+        rules = Sequitur.get_rules(s.get_start_rule_node())
+        self.assertIs(rules[0], s.get_start_rule_node())
+        self.assertEqual(len(rules), len(set(rules)))
+        self.assertEqual(rules, Sequitur.get_rules(s.get_start_rule_node()))
+        # every rule is used by one that comes before it
+        for i in range(1, len(rules)):
+            used = [n.get_rule_ptr() for r in rules[:i] for n in self.rhs_nodes(r)]
+            self.assertIn(rules[i], used)
+
+    @staticmethod
+    def rhs_nodes(rule_node):
+        nodes = []
+        node = Sequitur.get_rule_rhs(rule_node)
+        while not Sequitur.is_guard_node(node):
+            nodes.append(node)
+            node = node.get_next()
+        return nodes
+
+    def test_rule_ids_unbounded_and_per_instance(self):
+        seq = list('abcdefghij' * 3)
+        s1 = Sequitur()
+        s1.consume_sequence([a + b for a in 'abcdefghij' for b in 'abcdefghij'] * 2)
+        self.assertGreater(s1.num_rules, 26)
+        rules = s1.snapshot()
+        self.assertEqual(len(rules), len(Sequitur.get_rules(s1.get_start_rule_node())))
+        s2 = Sequitur()
+        s2.consume_sequence(seq)
+        self.assertEqual(s2.snapshot().keys(), Sequitur.run(seq).snapshot().keys())
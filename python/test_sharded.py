@@ -0,0 +1,33 @@
+from unittest import TestCase
+from cfg import CFG
+from sharded import induce_corpus, induce_document, merge_grammars, shard_corpus
+
+
+class TestSharded(TestCase):
+    docs = [list('abcabcabd'), list('xyzxyz'), list('abcabcabd'), [], list('abcabxyxy')]
+
+    @staticmethod
+    def expand(grammar, rhs):
+        vals = []
+        for sym in rhs:
+            vals.extend([sym.val] if sym.is_terminal else TestSharded.expand(grammar, grammar.rules[sym.val][0]))
+        return vals
+
+    def test_shard_corpus(self):
+        shards = shard_corpus(list(range(10)), 3)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual([x for shard in shards for x in shard], list(range(10)))
+
+    def test_merge_unifies_identical_rules(self):
+        grammar = merge_grammars([induce_document(list('abab')), induce_document(list('ababab'))])
+        self.assertEqual(len(grammar.rules), 2)
+        starts = grammar.rules[CFG.START_SYMBOL]
+        self.assertEqual([self.expand(grammar, rhs) for rhs in starts], [list('abab'), list('ababab')])
+
+    def test_induce_corpus(self):
+        serial = induce_corpus(self.docs, processes=1)
+        parallel = induce_corpus(self.docs, processes=2, num_shards=3)
+        self.assertEqual(serial.to_serializable(), parallel.to_serializable())
+        starts = parallel.rules[CFG.START_SYMBOL]
+        self.assertEqual([self.expand(parallel, rhs) for rhs in starts], self.docs)
+        self.assertEqual(starts[0], starts[2])